@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""Benchmarks for graph construction and build file generation.
+
+Each benchmark builds a synthetic graph of the given size and shape, then
+times construction, Ninju._generate() and ninja_syntax.Writer separately and
+records the peak memory used during construction, as well as generation with
+optimize=True and construction in stream mode. The jobs benchmark compares
+serial generation with generate(jobs=N). Features missing from the benchmarked
+revision are skipped, so that older revisions can be compared. Results are written as
+JSON so that two revisions can be compared with --compare.
+
+    python benchmarks/bench.py --size 10000 --output new.json
+    python benchmarks/bench.py --compare old.json new.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+from io import StringIO
+
+sourcedir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(sourcedir, '../src'))
+
+import ninja_syntax
+from ninju import Ninju, NinjuWarning
+
+
+class _Resolver(object):
+    """Resolves every executable to itself, so that benchmarks do not
+    depend on PATH."""
+
+    def resolve(self, path):
+        return path
+
+
+def _ninju(**kwargs):
+    try:
+        return Ninju(no_cwd_check=True, script=os.path.abspath(__file__),
+                     resolver=_Resolver(), **kwargs)
+    except TypeError:
+        # Revisions older than the script and resolver arguments
+        return Ninju(no_cwd_check=True, **kwargs)
+
+
+def chain(n, size):
+    """Long pipelines built with chained command methods."""
+    src = n.dir('src')
+    for i in range(4):
+        n.cmd('step{}'.format(i), 'bin{}'.format(i), '${in} ${out}')
+    for i in range(size // 4):
+        src('file{}.txt'.format(i)).step0().step1().step2().step3()
+
+
+def fanin(n, size):
+    """Wide fan-in of many intermediate files with n.files()."""
+    src = n.dir('data', 'src')
+    n.cmd('convert', 'convert', '${in} ${out}')
+    n.cmd('union', 'union', '${in} ${out}')
+    width = 100
+    for i in range(max(1, size // width)):
+        parts = [src('part{}_{}.csv'.format(i, j)).convert()
+                 for j in range(width)]
+        n.files(parts).union(n.builddir('union{}.csv'.format(i)))
+
+
+def rules(n, size):
+    """Many rules declared with cmd(), each used once."""
+    src = n.dir('src')
+    for i in range(size):
+        name = 'rule{}'.format(i)
+        n.cmd(name, 'tool{}'.format(i % 10), '--id {} ${{in}} ${{out}}'.format(i),
+              description='Rule {} ${{in}}'.format(i))
+        getattr(src('file{}.txt'.format(i)), name)()
+
+
+def names(n, size):
+    """Heavy use of generated intermediate names."""
+    src = n.dir('src')
+    n.cmd('split', 'split', '${in} ${out}')
+    for i in range(max(1, size // 10)):
+        src('file{}.txt'.format(i)).split(outputs=10)
+
+
+SHAPES = {
+    'chain': chain,
+    'fanin': fanin,
+    'rules': rules,
+    'names': names,
+}
+
+
+def _writer_lines(size):
+    paths = ['${{root}}/data/src/dir{}/file{}.txt'.format(i % 100, i)
+             for i in range(size)]
+    return [(paths[i], paths[max(0, i - 50):i + 1]) for i in range(size)]
+
+
+def bench_shape(shape, size):
+    # Memory is measured in a separate run as tracemalloc slows down
+    # allocations.
+    gc.collect()
+    tracemalloc.start()
+    SHAPES[shape](_ninju(), size)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    gc.collect()
+    start = time.perf_counter()
+    n = _ninju()
+    SHAPES[shape](n, size)
+    construct = time.perf_counter() - start
+
+    output = StringIO()
+    start = time.perf_counter()
+    n._generate(output)
+    generate = time.perf_counter() - start
+
+    result = {
+        'benchmark': shape,
+        'size': size,
+        'construct_s': construct,
+        'generate_s': generate,
+        'peak_bytes': peak,
+        'manifest_bytes': len(output.getvalue().encode('utf-8')),
+    }
+
+    # Features missing from older revisions are left out of the results.
+    try:
+        start = time.perf_counter()
+        n._generate(StringIO(), optimize=True)
+        result['optimize_s'] = time.perf_counter() - start
+    except TypeError:
+        pass
+
+    try:
+        gc.collect()
+        tracemalloc.start()
+        SHAPES[shape](_ninju(stream=True, spool_size=1), size)
+        result['stream_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+    except TypeError:
+        pass
+    finally:
+        tracemalloc.stop()
+
+    try:
+        gc.collect()
+        start = time.perf_counter()
+        n = _ninju(stream=True, spool_size=1)
+        SHAPES[shape](n, size)
+        n._generate(StringIO())
+        result['stream_s'] = time.perf_counter() - start
+    except TypeError:
+        pass
+    return result
+
+
+def bench_writer(size):
+    lines = _writer_lines(size)
+    output = StringIO()
+    writer = ninja_syntax.Writer(output)
+    start = time.perf_counter()
+    for out, ins in lines:
+        writer.build(out, 'cat', inputs=ins)
+    elapsed = time.perf_counter() - start
+    return {
+        'benchmark': 'writer',
+        'size': size,
+        'write_s': elapsed,
+        'manifest_bytes': len(output.getvalue().encode('utf-8')),
+    }
+
+
+def bench_jobs(size, jobs):
+    """Generation of the chain graph without and with jobs workers."""
+    n = _ninju()
+    chain(n, size)
+    result = {'benchmark': 'jobs', 'size': size, 'jobs': jobs}
+    for key, j in (('serial_s', None), ('parallel_s', jobs)):
+        output = StringIO()
+        start = time.perf_counter()
+        try:
+            n._generate(output, jobs=j)
+        except TypeError:
+            return None
+        result[key] = time.perf_counter() - start
+    return result
+
+
+def run(shapes, size, repeat, jobs):
+    results = []
+    for shape in shapes:
+        runs = [bench_shape(shape, size) for _ in range(repeat)]
+        results.append(_best(runs))
+    results.append(_best([bench_writer(size) for _ in range(repeat)]))
+    if jobs > 1 and bench_jobs(1, jobs) is not None:
+        result = _best([bench_jobs(size, jobs) for _ in range(repeat)])
+        result['speedup'] = result['serial_s'] / result['parallel_s']
+        results.append(result)
+    return results
+
+
+def _best(runs):
+    """Keeps the fastest time and the lowest memory of the runs."""
+    result = dict(runs[0])
+    for key in result:
+        if key.endswith(('_s', 'peak_bytes')):
+            result[key] = min(r[key] for r in runs)
+    return result
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=sourcedir,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    old_results = {(r['benchmark'], r['size']): r for r in old['results']}
+
+    print('{:<10} {:>8} {:<16} {:>12} {:>12} {:>8}'.format(
+        'benchmark', 'size', 'metric', 'old', 'new', 'ratio'))
+    for r in new['results']:
+        o = old_results.get((r['benchmark'], r['size']))
+        if o is None:
+            continue
+        for key in sorted(r):
+            if key in ('benchmark', 'size') or key not in o:
+                continue
+            ratio = r[key] / o[key] if o[key] else float('nan')
+            print('{:<10} {:>8} {:<16} {:>12.4g} {:>12.4g} {:>8.3f}'.format(
+                r['benchmark'], r['size'], key, o[key], r[key], ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=10000,
+                        help='number of build edges per benchmark')
+    parser.add_argument('--shape', action='append', choices=sorted(SHAPES),
+                        help='graph shape to benchmark (default: all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs, the best one is reported')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of workers of the generate(jobs=N) '
+                             'benchmark, which is skipped when 1')
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two JSON result files')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    warnings.simplefilter('ignore', category=NinjuWarning)
+    data = {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': run(args.shape or sorted(SHAPES), args.size, args.repeat,
+                       args.jobs),
+    }
+    text = json.dumps(data, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,12 +9,22 @@ use Python.
 
 import re
 import textwrap
+from bisect import bisect_left
 
 def escape_path(word):
     return word.replace('$ ', '$$ ').replace(' ', '$ ').replace(':', '$:')
 
+def _escape_paths(paths):
+    """Returns the escaped paths separated by spaces."""
+    line = ' '.join(paths)
+    # Most paths need no escaping, which is checked on the whole line.
+    if ':' in line or line.count(' ') != len(paths) - 1:
+        line = ' '.join([escape_path(x) for x in paths])
+    return line
+
 class Writer(object):
     def __init__(self, output, width=78):
+        """If width is None, lines are never wrapped."""
         self.output = output
         self.width = width
 
@@ -22,6 +32,9 @@ class Writer(object):
         self.output.write('\n')
 
     def comment(self, text, has_path=False):
+        if self.width is None:
+            self.output.write('# ' + text + '\n')
+            return
         for line in textwrap.wrap(text, self.width - 2, break_long_words=False,
                                   break_on_hyphens=False):
             self.output.write('# ' + line + '\n')
@@ -62,25 +75,23 @@ class Writer(object):
     def build(self, outputs, rule, inputs=None, implicit=None, order_only=None,
               variables=None, implicit_outputs=None):
         outputs = as_list(outputs)
-        out_outputs = [escape_path(x) for x in outputs]
-        all_inputs = [escape_path(x) for x in as_list(inputs)]
-
+        parts = ['build ', _escape_paths(outputs)]
+        if implicit_outputs:
+            parts.append(' | ')
+            parts.append(_escape_paths(as_list(implicit_outputs)))
+        parts.append(': ')
+        parts.append(rule)
+        inputs = as_list(inputs)
+        if inputs:
+            parts.append(' ')
+            parts.append(_escape_paths(inputs))
         if implicit:
-            implicit = [escape_path(x) for x in as_list(implicit)]
-            all_inputs.append('|')
-            all_inputs.extend(implicit)
+            parts.append(' | ')
+            parts.append(_escape_paths(as_list(implicit)))
         if order_only:
-            order_only = [escape_path(x) for x in as_list(order_only)]
-            all_inputs.append('||')
-            all_inputs.extend(order_only)
-        if implicit_outputs:
-            implicit_outputs = [escape_path(x)
-                                for x in as_list(implicit_outputs)]
-            out_outputs.append('|')
-            out_outputs.extend(implicit_outputs)
-
-        self._line('build %s: %s' % (' '.join(out_outputs),
-                                     ' '.join([rule] + all_inputs)))
+            parts.append(' || ')
+            parts.append(_escape_paths(as_list(order_only)))
+        self._line(''.join(parts))
 
         if variables:
             if isinstance(variables, dict):
@@ -102,50 +113,74 @@ class Writer(object):
     def default(self, paths):
         self._line('default %s' % ' '.join(as_list(paths)))
 
-    def _count_dollars_before_index(self, s, i):
-        """Returns the number of '$' characters right in front of s[i]."""
+    def _is_escaped_space(self, s, i, start=0):
+        """Returns True if the space at s[i] is escaped with '$'.
+
+        Only the '$' characters after s[start] are counted, as the line is
+        wrapped at the space right before s[start].
+        """
         dollar_count = 0
         dollar_index = i - 1
-        while dollar_index > 0 and s[dollar_index] == '$':
+        while dollar_index > start and s[dollar_index] == '$':
             dollar_count += 1
             dollar_index -= 1
-        return dollar_count
+        return dollar_count % 2 == 1
 
     def _line(self, text, indent=0):
         """Write 'text' word-wrapped at self.width characters."""
         leading_space = '  ' * indent
-        while len(leading_space) + len(text) > self.width:
+        if self.width is None or len(leading_space) + len(text) <= self.width:
+            self.output.write(leading_space + text + '\n')
+            return
+
+        # Collect the positions of all spaces once, then walk through the
+        # text by index instead of slicing off each wrapped line.
+        spaces = []
+        space = text.find(' ')
+        while space >= 0:
+            spaces.append(space)
+            space = text.find(' ', space + 1)
+
+        pieces = []
+        start = 0
+        while len(leading_space) + len(text) - start > self.width:
             # The text is too wide; wrap if possible.
 
             # Find the rightmost space that would obey our width constraint and
             # that's not an escaped space.
-            available_space = self.width - len(leading_space) - len(' $')
-            space = available_space
-            while True:
-                space = text.rfind(' ', 0, space)
-                if (space < 0 or
-                    self._count_dollars_before_index(text, space) % 2 == 0):
+            limit = start + self.width - len(leading_space) - len(' $')
+            k = bisect_left(spaces, limit) - 1
+            space = -1
+            while k >= 0 and spaces[k] >= start:
+                if not self._is_escaped_space(text, spaces[k], start):
+                    space = spaces[k]
                     break
+                k -= 1
 
             if space < 0:
                 # No such space; just use the first unescaped space we can find.
-                space = available_space - 1
-                while True:
-                    space = text.find(' ', space + 1)
-                    if (space < 0 or
-                        self._count_dollars_before_index(text, space) % 2 == 0):
+                k = bisect_left(spaces, limit)
+                while k < len(spaces):
+                    if not self._is_escaped_space(text, spaces[k], start):
+                        space = spaces[k]
                         break
+                    k += 1
             if space < 0:
                 # Give up on breaking.
                 break
 
-            self.output.write(leading_space + text[0:space] + ' $\n')
-            text = text[space+1:]
+            pieces.append(leading_space)
+            pieces.append(text[start:space])
+            pieces.append(' $\n')
+            start = space + 1
 
             # Subsequent lines are continuations, so indent them.
             leading_space = '  ' * (indent+2)
 
-        self.output.write(leading_space + text + '\n')
+        pieces.append(leading_space)
+        pieces.append(text[start:])
+        pieces.append('\n')
+        self.output.write(''.join(pieces))
 
     def close(self):
         self.output.close()
@@ -167,15 +202,90 @@ def escape(string):
     return string.replace('$', '$$')
 
 
+# $$, $ , $:, a line continuation, ${name} or $name
+_VARIABLE = re.compile(r'\$(?:[$ :]|(\n *)|\{([a-zA-Z0-9_.-]*)\}|([a-zA-Z0-9_-]*))')
+_ESCAPES = {'$$': '$', '$ ': ' ', '$:': ':'}
+_CACHE_SIZE = 4096
+_names = {}
+
+
+def variables(string):
+    """Returns the names of the variables used in string. Results are
+    cached."""
+    names = _names.get(string)
+    if names is None:
+        names = tuple(n for m in _VARIABLE.finditer(string)
+                      for n in (m.group(2) or m.group(3),) if n)
+        if len(_names) >= _CACHE_SIZE:
+            _names.clear()
+        _names[string] = names
+    return names
+
+
 def expand(string, vars, local_vars={}):
     """Expand a string containing $vars as Ninja would.
 
-    Note: doesn't handle the full Ninja variable syntax, but it's enough
-    to make configure.py's use of it work.
+    Undefined variables expand to nothing, and $$, '$ ', $: and line
+    continuations are unescaped.
     """
+    if '$' not in string:
+        return string
+
     def exp(m):
-        var = m.group(1)
-        if var == '$':
-            return '$'
-        return local_vars.get(var, vars.get(var, ''))
-    return re.sub(r'\$(\$|\w*)', exp, string)
+        name = m.group(2) or m.group(3)
+        if name:
+            value = local_vars.get(name)
+            if value is None:
+                value = vars.get(name, '')
+            return value
+        if m.group(1) is not None:
+            return ''
+        # A lone '$' is not valid in ninja and is kept as written.
+        return _ESCAPES.get(m.group(0), m.group(0))
+    return _VARIABLE.sub(exp, string)
+
+
+class Expander(object):
+    """Expands strings in a scope of variables, e.g. the top-level variables
+    of a build file, remembering the results.
+
+    Results are forgotten when a variable they use is defined again.
+    """
+
+    def __init__(self, vars=None):
+        self.vars = {} if vars is None else vars
+        self._memo = {}
+        self._users = {}
+
+    def define(self, name, value):
+        """Sets variable name to value, which is already expanded."""
+        self.vars[name] = value
+        memo = self._memo
+        for string in self._users.pop(name, ()):
+            memo.pop(string, None)
+
+    def expand(self, string):
+        if '$' not in string:
+            return string
+        # Fast path for paths like ${root}/file
+        if string.startswith('${'):
+            end = string.find('}')
+            if end > 0 and string.find('$', end) < 0:
+                value = self.vars.get(string[2:end])
+                if value is not None:
+                    return value + string[end + 1:]
+        value = self._memo.get(string)
+        if value is not None:
+            return value
+        if len(self._memo) >= _CACHE_SIZE:
+            self._memo.clear()
+            self._users.clear()
+        value = expand(string, self.vars)
+        self._memo[string] = value
+        users = self._users
+        for name in variables(string):
+            s = users.get(name)
+            if s is None:
+                users[name] = s = set()
+            s.add(string)
+        return value
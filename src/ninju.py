@@ -1,9 +1,22 @@
+import argparse
+import asyncio
+import fnmatch
+import hashlib
 import inspect
+import io
+import json
+import mmap
+import multiprocessing
 import os
+import re
 import shutil
 import sys
+import tempfile
 import warnings
-from string import Template
+import zlib
+from collections import namedtuple
+from array import array
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
 import ninja_syntax
 from ninja_syntax import as_list
@@ -15,6 +28,17 @@ NINJA_REQUIRED_VERSION = '1.7'
 NINJU_MODULE_PATH = os.path.abspath(__file__)
 NINJA_SYNTAX_MODULE_PATH = os.path.abspath(ninja_syntax.__file__)
 
+# Graph with call sites written in $builddir when record_sites is enabled.
+GRAPH_FILE = '.ninju_graph.json'
+SNAPSHOT_SUFFIX = '.snap'
+_SNAPSHOT_MAGIC = b'NINJUSN1'
+
+# Characters that ninja leaves unquoted in $in and $out on POSIX
+_SHELL_SAFE = re.compile(r'[A-Za-z0-9_+,./-]*\Z')
+
+# Minimum number of build edges formatted by one job of generate(jobs=N).
+_MIN_CHUNK = 1000
+
 
 class NinjuWarning(Warning):
     pass
@@ -35,6 +59,559 @@ class GeneratorError(Exception):
         Exception.__init__(self, *args, **kwargs)
 
 
+class ExeResolver(object):
+    """Finds executables and memoizes the results.
+
+    Results are cached for the process and dropped when PATH changes or
+    invalidate() is called. If cache_file is given, the results of PATH
+    lookups are also stored in that file by save() and reused by later
+    processes as long as PATH and the mtimes of its directories are the same.
+
+    Any object with a resolve(path) method can be given to Ninju in place of
+    an ExeResolver, e.g. to avoid hitting the filesystem in tests.
+    """
+
+    def __init__(self, cache_file=None):
+        super(ExeResolver, self).__init__()
+        self._cache_file = cache_file
+        self._env_path = None
+        self._cache = {}
+        self._lookups = None
+        self._dirty = False
+
+    def resolve(self, path):
+        """Returns path if it is an executable file, otherwise the executable
+        found on PATH or None."""
+        env_path = os.environ.get('PATH')
+        if env_path != self._env_path:
+            self.invalidate()
+            self._env_path = env_path
+
+        if os.path.isabs(path):
+            key = path
+        else:
+            key = (path, os.getcwd())
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            p = path
+        else:
+            p = self._which(path)
+        self._cache[key] = p
+        return p
+
+    def invalidate(self):
+        """Forgets every resolved executable."""
+        self._cache.clear()
+        self._lookups = None
+        self._dirty = False
+
+    def save(self):
+        """Stores the PATH lookups in cache_file."""
+        if self._cache_file is None or not self._dirty:
+            return
+        data = {
+            'fingerprint': self._fingerprint(),
+            'lookups': self._lookups,
+        }
+        _write_if_changed(self._cache_file,
+                          lambda output: json.dump(data, output, sort_keys=True))
+        self._dirty = False
+
+    def _which(self, path):
+        if self._cache_file is None or os.sep in path:
+            return _which(path)
+
+        if self._lookups is None:
+            self._lookups = self._load()
+        try:
+            return self._lookups[path]
+        except KeyError:
+            pass
+        p = _which(path)
+        self._lookups[path] = p
+        self._dirty = True
+        return p
+
+    def _load(self):
+        try:
+            with open(self._cache_file, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('fingerprint') != self._fingerprint():
+            return {}
+        return data.get('lookups', {})
+
+    def _fingerprint(self):
+        env_path = os.environ.get('PATH', os.defpath)
+        mtimes = []
+        for d in env_path.split(os.pathsep):
+            try:
+                mtimes.append(os.stat(d or os.curdir).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return [env_path, mtimes]
+
+
+def _which(path):
+    try:
+        return shutil.which(path)
+    except Exception:
+        return None
+
+
+_default_resolver = ExeResolver()
+
+
+Edge = namedtuple('Edge', ['rule', 'outputs', 'inputs'])
+
+# Path groups of an edge in _EdgeStore
+_OUTPUTS, _IMPLICIT_OUTPUTS, _INPUTS, _IMPLICIT, _ORDER_ONLY = range(5)
+_GROUPS = 5
+
+
+class _EdgeStore(object):
+    """Build edges stored in flat arrays instead of one object per edge.
+
+    Paths, rule names and edge variables are interned into integer ids. The
+    path ids of all edges are concatenated in ids, each edge having five
+    groups: outputs, implicit outputs, inputs, implicit inputs and order-only
+    inputs. ends[_GROUPS * e + g] is the offset where group g of edge e ends.
+
+    Paths are found by an open addressing hash table of path ids plus one,
+    which is much smaller than a dict of int objects.
+    """
+
+    def __init__(self):
+        super(_EdgeStore, self).__init__()
+        self.paths = []
+        self._table = array('I', bytes(4 * 8))
+        self._names = []
+        self._name_ids = {}
+        self._variables = [None]
+        self._variable_ids = {}
+        self.ids = array('I')
+        self.ends = array('I')
+        self.rule_ids = array('I')
+        self.variable_ids = array('I')
+        # Path id -> index of the edge producing it plus one, or 0
+        self.producers = array('I')
+        self._consumer_starts = None
+        self._consumer_ids = None
+
+    def __len__(self):
+        return len(self.rule_ids)
+
+    def _slot(self, path):
+        table = self._table
+        paths = self.paths
+        mask = len(table) - 1
+        slot = hash(path) & mask
+        while True:
+            i = table[slot]
+            if i == 0 or paths[i - 1] == path:
+                return slot
+            slot = (slot + 1) & mask
+
+    def path_id(self, path):
+        """Returns the id of path, or None."""
+        i = self._table[self._slot(path)]
+        return i - 1 if i else None
+
+    def _intern(self, path):
+        path = str(path)
+        slot = self._slot(path)
+        i = self._table[slot]
+        if i:
+            return i - 1
+        paths = self.paths
+        paths.append(path)
+        self.producers.append(0)
+        self._table[slot] = len(paths)
+        if 2 * len(paths) > len(self._table):
+            table = array('I', bytes(8 * len(self._table)))
+            mask = len(table) - 1
+            for i, p in enumerate(paths):
+                slot = hash(p) & mask
+                while table[slot]:
+                    slot = (slot + 1) & mask
+                table[slot] = i + 1
+            self._table = table
+        return len(paths) - 1
+
+    def _intern_name(self, name):
+        i = self._name_ids.get(name)
+        if i is None:
+            i = len(self._names)
+            self._name_ids[name] = i
+            self._names.append(name)
+        return i
+
+    def _intern_variables(self, variables):
+        if not variables:
+            return 0
+        if isinstance(variables, dict):
+            variables = variables.items()
+        key = tuple(tuple(v) for v in variables)
+        try:
+            i = self._variable_ids.get(key)
+        except TypeError:
+            # Values are lists, which cannot be shared.
+            self._variables.append(key)
+            return len(self._variables) - 1
+        if i is None:
+            i = len(self._variables)
+            self._variable_ids[key] = i
+            self._variables.append(key)
+        return i
+
+    def add(self, rule, groups, variables=None):
+        """Adds an edge with the five path groups and returns its index.
+        Raises ConfigurationError if one of its outputs is already produced
+        by another edge."""
+        index = len(self.rule_ids)
+        ids = self.ids
+        ends = self.ends
+        start = len(ids)
+        for group in groups:
+            for p in _flatten(group):
+                ids.append(self._intern(p))
+            ends.append(len(ids))
+
+        # Outputs are marked as they are checked, which also finds an
+        # output repeated in this edge.
+        producers = self.producers
+        outputs = ids[start:ends[-4]]
+        for k, o in enumerate(outputs):
+            if producers[o]:
+                for marked in outputs[:k]:
+                    producers[marked] = 0
+                del ids[start:]
+                del ends[_GROUPS * index:]
+                raise ConfigurationError(
+                    'multiple rules generate {}'.format(self.paths[o]))
+            producers[o] = index + 1
+        self.rule_ids.append(self._intern_name(rule))
+        self.variable_ids.append(self._intern_variables(variables))
+        self._consumer_starts = None
+        return index
+
+    def group_ids(self, index, first, last=None):
+        """Returns the path ids of groups first to last of an edge."""
+        base = _GROUPS * index
+        start = self.ends[base + first - 1] if base + first else 0
+        return self.ids[start:self.ends[base + (first if last is None else last)]]
+
+    def group(self, index, first, last=None):
+        paths = self.paths
+        return tuple(paths[i] for i in self.group_ids(index, first, last))
+
+    def rule(self, index):
+        return self._names[self.rule_ids[index]]
+
+    def variables(self, index):
+        return self._variables[self.variable_ids[index]]
+
+    def write(self, writer, index):
+        """Writes edge index as a build statement."""
+        ends = self.ends
+        base = _GROUPS * index
+        start = ends[base - 1] if base else 0
+        outputs = ends[base] - start
+        if not outputs:
+            raise GeneratorError('no output')
+        implicit_outputs = ends[base + 1] - start
+        inputs = ends[base + 2] - start
+        implicit = ends[base + 3] - start
+        paths = self.paths
+        p = list(map(paths.__getitem__, self.ids[start:ends[base + 4]]))
+        writer.build(
+            p[:outputs],
+            self._names[self.rule_ids[index]],
+            inputs=p[implicit_outputs:inputs],
+            implicit=p[inputs:implicit],
+            order_only=p[implicit:],
+            variables=self._variables[self.variable_ids[index]],
+            implicit_outputs=p[outputs:implicit_outputs])
+
+    def output_ids(self, index):
+        return self.group_ids(index, _OUTPUTS, _IMPLICIT_OUTPUTS)
+
+    def input_ids(self, index):
+        return self.group_ids(index, _INPUTS, _ORDER_ONLY)
+
+    def consumer_ids(self, path_id):
+        """Returns the indexes of the edges using a path as an input."""
+        if self._consumer_starts is None:
+            self._index_consumers()
+        starts = self._consumer_starts
+        if path_id + 1 >= len(starts):
+            return ()
+        return self._consumer_ids[starts[path_id]:starts[path_id + 1]]
+
+    def _index_consumers(self):
+        # Edges using each path, in edge order, stored like ids and ends.
+        counts = array('I', bytes(4 * (len(self.paths) + 1)))
+        inputs = [set(self.input_ids(e)) for e in range(len(self))]
+        for used in inputs:
+            for i in used:
+                counts[i + 1] += 1
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+        fill = counts[:-1]
+        consumers = array('I', bytes(4 * counts[-1]))
+        for e, used in enumerate(inputs):
+            for i in used:
+                consumers[fill[i]] = e
+                fill[i] += 1
+        self._consumer_starts = counts
+        self._consumer_ids = consumers
+
+
+class BuildGraph(object):
+    """Index of the build edges declared in a Ninju object.
+
+    Paths are compared as written, e.g. '${builddir}/a' and
+    '${root}/.builddir/a' are different paths. inputs of an edge include its
+    implicit and order-only dependencies.
+    """
+
+    def __init__(self, store=None):
+        super(BuildGraph, self).__init__()
+        self._store = store if store is not None else _EdgeStore()
+
+    def add(self, rule, outputs, inputs):
+        """Adds an edge. Raises ConfigurationError if one of its outputs is
+        already produced by another edge."""
+        self._store.add(rule, (outputs, (), inputs, (), ()))
+
+    def __len__(self):
+        return len(self._store)
+
+    def __iter__(self):
+        return (self._edge(i) for i in range(len(self._store)))
+
+    def _edge(self, index):
+        store = self._store
+        return Edge(store.rule(index),
+                    store.group(index, _OUTPUTS, _IMPLICIT_OUTPUTS),
+                    store.group(index, _INPUTS, _ORDER_ONLY))
+
+    def producer(self, path):
+        """Returns the edge producing path, or None."""
+        i = self._store.path_id(_single_path(path))
+        if i is None or not self._store.producers[i]:
+            return None
+        return self._edge(self._store.producers[i] - 1)
+
+    def consumers(self, path):
+        """Returns the edges using path as an input."""
+        i = self._store.path_id(_single_path(path))
+        if i is None:
+            return []
+        return [self._edge(e) for e in self._store.consumer_ids(i)]
+
+    def dependencies(self, path):
+        """Returns every path that path is built from, directly or not."""
+        store = self._store
+        result = set()
+        i = store.path_id(_single_path(path))
+        stack = [] if i is None else [i]
+        while stack:
+            e = store.producers[stack.pop()]
+            if not e:
+                continue
+            for i in store.input_ids(e - 1):
+                if i not in result:
+                    result.add(i)
+                    stack.append(i)
+        return set(store.paths[i] for i in result)
+
+    def dependents(self, path):
+        """Returns every output that is built from path, directly or not."""
+        store = self._store
+        result = set()
+        i = store.path_id(_single_path(path))
+        stack = [] if i is None else [i]
+        while stack:
+            for e in store.consumer_ids(stack.pop()):
+                for o in store.output_ids(e):
+                    if o not in result:
+                        result.add(o)
+                        stack.append(o)
+        return set(store.paths[i] for i in result)
+
+    def sources(self):
+        """Returns the inputs that no edge produces."""
+        store = self._store
+        used = set()
+        for e in range(len(store)):
+            used.update(store.input_ids(e))
+        producers = store.producers
+        return [store.paths[i] for i in sorted(used) if not producers[i]]
+
+    def find_cycle(self):
+        """Returns a list of paths forming a dependency cycle, or None.
+
+        Runs in time linear in the size of the graph.
+        """
+        store = self._store
+        producers = store.producers
+        count = len(store)
+        pending = [0] * count
+        for index in range(count):
+            for i in set(store.input_ids(index)):
+                if producers[i]:
+                    pending[index] += 1
+
+        ready = [index for index, n in enumerate(pending) if n == 0]
+        done = 0
+        while ready:
+            index = ready.pop()
+            done += 1
+            for o in store.output_ids(index):
+                for c in store.consumer_ids(o):
+                    pending[c] -= 1
+                    if pending[c] == 0:
+                        ready.append(c)
+        if done == count:
+            return None
+
+        # Every remaining edge has an input produced by a remaining edge, so
+        # following them must eventually come back to a visited edge.
+        index = next(i for i, n in enumerate(pending) if n > 0)
+        seen = {}
+        path = []
+        while index not in seen:
+            seen[index] = len(path)
+            for i in store.input_ids(index):
+                p = producers[i] - 1
+                if p >= 0 and pending[p] > 0:
+                    path.append(store.paths[i])
+                    index = p
+                    break
+        cycle = path[seen[index]:]
+        cycle.reverse()
+        return cycle + cycle[:1]
+
+
+class _PathTable(object):
+    """Paths of a snapshot, decoded when they are used."""
+
+    def __init__(self, mm, data, offsets, order):
+        super(_PathTable, self).__init__()
+        self._mm = mm
+        self._data = data
+        self._offsets = offsets
+        self._order = order
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _bytes(self, i):
+        return self._mm[self._data + self._offsets[i]:self._data + self._offsets[i + 1]]
+
+    def __getitem__(self, i):
+        return self._bytes(i).decode('utf-8')
+
+    def find(self, path):
+        """Returns the id of path by a binary search, or None."""
+        key = path.encode('utf-8')
+        order = self._order
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(order) and self._bytes(order[lo]) == key:
+            return order[lo]
+        return None
+
+
+class _SnapshotStore(_EdgeStore):
+    """An _EdgeStore whose arrays are views of a memory mapped snapshot."""
+
+    def __init__(self, path):
+        # Nothing is interned, so _EdgeStore.__init__ is not called.
+        with open(path, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                mm = b''
+        if mm[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+            raise ExecutionError('not a Ninju snapshot: {}'.format(path))
+        start = len(_SNAPSHOT_MAGIC) + 4
+        size = int.from_bytes(mm[start - 4:start], 'little')
+        header = json.loads(mm[start:start + size].decode('utf-8'))
+        if header['version'] != 1 or header['byteorder'] != sys.byteorder:
+            raise ExecutionError('unsupported Ninju snapshot: {}'.format(path))
+        base = _align(start + size)
+        view = memoryview(mm)
+
+        def section(name):
+            offset, length = header['sections'][name]
+            return view[base + offset:base + offset + length].cast('I')
+
+        self.header = header
+        self.paths = _PathTable(mm, base + header['sections']['path_data'][0],
+                                section('path_offsets'), section('sorted_paths'))
+        self._names = header['rule_names']
+        self._variables = None
+        self._variables_section = header['sections']['variables']
+        self._mm = mm
+        self._base = base
+        for name in ('ids', 'ends', 'rule_ids', 'variable_ids', 'producers'):
+            setattr(self, name, section(name))
+        self._consumer_starts = section('consumer_starts')
+        self._consumer_ids = section('consumer_ids')
+
+    def path_id(self, path):
+        return self.paths.find(path)
+
+    def add(self, rule, groups, variables=None):
+        raise ConfigurationError('a snapshot cannot be changed')
+
+    def variables(self, index):
+        if self._variables is None:
+            offset, length = self._variables_section
+            start = self._base + offset
+            self._variables = json.loads(self._mm[start:start + length].decode('utf-8'))
+        return self._variables[self.variable_ids[index]]
+
+
+class Snapshot(BuildGraph):
+    """Read-only graph loaded from a snapshot written by
+    generate(snapshot=True), see Ninju.load_snapshot().
+
+    rules maps rule names to their attributes, pools maps pool names to their
+    depth and vars holds the expanded top-level variables.
+    """
+
+    def __init__(self, path):
+        super(Snapshot, self).__init__(_SnapshotStore(path))
+        header = self._store.header
+        self.rules = header['rules']
+        self.pools = header['pools']
+        self.vars = header['vars']
+
+    def variables(self, path):
+        """Returns the variables of the edge producing path, or None."""
+        i = self._store.path_id(_single_path(path))
+        if i is None or not self._store.producers[i]:
+            return None
+        return self._store.variables(self._store.producers[i] - 1)
+
+
+def _align(n):
+    return (n + 3) & ~3
+
+
 class _NVar(object):
     def __init__(self, name, value, indent=0):
         super(_NVar, self).__init__()
@@ -56,6 +633,41 @@ class _NPool(object):
         writer.pool(self.name, self.depth)
 
 
+class _NResourcePool(object):
+    """A pool whose depth is computed from the resources of the machine
+    when it is written."""
+
+    def __init__(self, name, cpu, mem_mb, resources):
+        super(_NResourcePool, self).__init__()
+        self.name = name
+        self.cpu = cpu
+        self.mem_mb = mem_mb
+        self.resources = resources
+
+    @property
+    def depth(self):
+        resources = self.resources()
+        depth = resources['cpu'] // self.cpu
+        if self.mem_mb != None and resources.get('mem_mb') != None:
+            depth = min(depth, resources['mem_mb'] // self.mem_mb)
+        return max(1, depth)
+
+    def write(self, writer):
+        writer.pool(self.name, self.depth)
+
+
+def _machine_resources():
+    try:
+        cpu = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpu = os.cpu_count() or 1
+    try:
+        mem_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        mem_mb = None
+    return {'cpu': cpu, 'mem_mb': mem_mb}
+
+
 class _NBuildRule(object):
     def __init__(self, name, executable, args=None, description=None, depfile=None,
                  generator=False, pool=None, restat=False, rspfile=None,
@@ -96,19 +708,48 @@ class _NBuildRule(object):
 
         def fn(inputs, outputs=None, implicit=None, order_only=None,
                 variables=None, implicit_outputs=None):
-            outs = _normalize_outputs(outputs, ninju._gen_name)
-            b = _NBuild(
+            gen_name = ninju._name_generator(
+                _self.name, inputs, implicit, order_only, variables)
+            outs = _normalize_outputs(outputs, gen_name)
+            ninju._add_build(
                 outs,
                 _self.name,
                 inputs=inputs,
-                implicit=ninju.files(_self.executable, implicit),
+                implicit=(_self.executable, implicit),
                 order_only=order_only,
                 variables=variables,
                 implicit_outputs=implicit_outputs)
-            ninju._seq.append(b)
             return ninju.files(*outs)
         return fn
 
+    def batch_fn(self, ninju):
+        _self = self
+        build = self.build_fn(ninju)
+
+        def fn(inputs, size, outputs=None, implicit=None, order_only=None,
+               variables=None):
+            if not isinstance(size, int) or size < 1:
+                raise ConfigurationError('batch size must be a positive integer')
+            inputs = _flatten(inputs)
+            if outputs == None:
+                outs = []
+                for i in inputs:
+                    outs.append(ninju._name_generator(
+                        _self.name, i, implicit, order_only, variables)())
+            else:
+                outs = _flatten(outputs)
+                if len(outs) != len(inputs):
+                    raise ConfigurationError('batch needs one output for each input')
+            if isinstance(variables, dict):
+                variables = list(variables.items())
+            for start in range(0, len(inputs), size):
+                chunk = list(outs[start:start + size])
+                build(inputs[start:start + size], chunk, implicit=implicit,
+                      order_only=order_only,
+                      variables=[('ninju_rsp', str(chunk[0]) + '.rsp')] + list(variables or []))
+            return ninju.files(outs)
+        return fn
+
 
 class _NExecRule(object):
     def __init__(self, name, executable, args=None, description=None,
@@ -142,13 +783,12 @@ class _NExecRule(object):
             if not _is_single_item(target):
                 raise ConfigurationError('exec_cmd can only have one target')
             outs = _normalize_outputs(target, ninju._gen_name)
-            b = _NBuild(
+            ninju._add_build(
                 outs,
                 _self.name,
                 inputs=inputs,
                 variables=variables)
-            ninju._seq.append(b)
-            return _Files(ninju, target)
+            return ninju.files(target)
         return fn
 
 
@@ -181,6 +821,62 @@ class _NBuild(object):
             implicit_outputs=_as_string_list(self.implicit_outputs))
 
 
+class _NEdge(_NBuild):
+    """A build statement stored in an _EdgeStore."""
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    outputs = property(lambda self: self._store.group(self._index, _OUTPUTS))
+    implicit_outputs = property(
+        lambda self: self._store.group(self._index, _IMPLICIT_OUTPUTS))
+    inputs = property(lambda self: self._store.group(self._index, _INPUTS))
+    implicit = property(lambda self: self._store.group(self._index, _IMPLICIT))
+    order_only = property(lambda self: self._store.group(self._index, _ORDER_ONLY))
+    rule = property(lambda self: self._store.rule(self._index))
+    variables = property(lambda self: self._store.variables(self._index))
+
+    def write(self, writer):
+        self._store.write(writer, self._index)
+
+
+class _NEdges(object):
+    """Consecutive build statements stored in an _EdgeStore, from index
+    start to stop."""
+
+    def __init__(self, store, start, stop):
+        super(_NEdges, self).__init__()
+        self.store = store
+        self.start = start
+        self.stop = stop
+
+    def __iter__(self):
+        store = self.store
+        return (_NEdge(store, i) for i in range(self.start, self.stop))
+
+
+def _splice(tasks):
+    """Returns tasks with the statements of slots in place of them."""
+    result = []
+    for task in tasks:
+        if isinstance(task, _NSlot):
+            result.extend(_splice(task.tasks))
+        else:
+            result.append(task)
+    return result
+
+
+def _statements(tasks):
+    """Iterates over the statements of tasks, one per build statement."""
+    for task in tasks:
+        if isinstance(task, _NEdges):
+            for edge in task:
+                yield edge
+        else:
+            yield task
+
+
 class _NPhony(object):
     def __init__(self, name, inputs):
         super(_NPhony, self).__init__()
@@ -195,6 +891,31 @@ class _NPhony(object):
         writer.build(self.name, 'phony', inputs=ins)
 
 
+class _NRaw(object):
+    """A statement that is already formatted, e.g. read from a section cache.
+
+    key is the first output of a build statement, or None for a default
+    statement.
+    """
+
+    def __init__(self, text, key):
+        super(_NRaw, self).__init__()
+        self.text = text
+        self.key = key
+
+    def write(self, writer):
+        writer.output.write(self.text)
+
+
+class _NInclude(object):
+    def __init__(self, path):
+        super(_NInclude, self).__init__()
+        self.path = path
+
+    def write(self, writer):
+        writer.include(self.path)
+
+
 class _NDefault(object):
     def __init__(self, targets):
         super(_NDefault, self).__init__()
@@ -208,25 +929,128 @@ class _NDefault(object):
         writer.default(targs)
 
 
+class _CountingOutput(object):
+    """File-like wrapper that counts the characters written through it."""
+
+    def __init__(self, output):
+        super(_CountingOutput, self).__init__()
+        self.output = output
+        self.count = 0
+
+    def write(self, s):
+        self.count += len(s)
+        self.output.write(s)
+
+    def close(self):
+        self.output.close()
+
+
+class _NStream(object):
+    """Serializes statements as soon as they are declared.
+
+    The text goes into a spooled temporary file that stays in memory up to
+    max_size characters and then rolls over to disk. Only the length of each
+    statement is kept, so newlines between statements can still be chosen
+    when the build file is generated.
+    """
+
+    def __init__(self, max_size, width=78):
+        super(_NStream, self).__init__()
+        self._spool = tempfile.SpooledTemporaryFile(
+            max_size=max_size, mode='w+', encoding='utf-8', newline='')
+        self._output = _CountingOutput(self._spool)
+        self._writer = ninja_syntax.Writer(self._output, width)
+        self._lengths = array('Q')
+
+    def write(self, task):
+        start = self._output.count
+        task.write(self._writer)
+        self._lengths.append(self._output.count - start)
+
+    def copy_to(self, output, newline=True):
+        self._spool.seek(0)
+        read = self._spool.read
+        write = output.write
+        if newline:
+            for length in self._lengths:
+                write(read(length))
+                write('\n')
+        else:
+            while True:
+                chunk = read(1 << 20)
+                if not chunk:
+                    break
+                write(chunk)
+        self._spool.seek(0, os.SEEK_END)
+
+    def close(self):
+        self._spool.close()
+
+
+class _NSlot(object):
+    """The place of statements declared later, see Ninju.later()."""
+
+    def __init__(self):
+        super(_NSlot, self).__init__()
+        self.tasks = []
+
+
+class Deferred(object):
+    """Statements declared once a future is done, see Ninju.later().
+
+    Awaiting it, or calling result(), waits for the future and returns what
+    the declaring function returns. Deferred objects declared before it are
+    resolved first, so statements and generated names do not depend on the
+    order in which futures finish. It cannot be resolved in a section.
+    """
+
+    def __init__(self, ninju, slot, future, fn):
+        super(Deferred, self).__init__()
+        self._n = ninju
+        self._slot = slot
+        self._future = future
+        self._fn = fn
+        self._done = False
+        self._value = None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            self._n._resolve(self)
+        return self._value
+
+    def __await__(self):
+        if not self._done:
+            yield from asyncio.wrap_future(self._future).__await__()
+        return self.result()
+
+    def _run(self):
+        ninju = self._n
+        seq, run = ninju._seq, ninju._run
+        ninju._seq, ninju._run = self._slot.tasks, None
+        try:
+            self._value = self._fn(self._future.result())
+        finally:
+            ninju._seq, ninju._run = seq, run
+        self._done = True
+
+
 class _Target(object):
+    """Exec commands are added as methods to a subclass made for each Ninju
+    object (see Ninju.exec_cmd)."""
+    __slots__ = ('_n', 'target')
+
     def __init__(self, ninju, target):
         super(_Target, self).__init__()
         self._n = ninju
         self.target = target
 
-    def __getattr__(self, name):
-        if name in self._n._exec_cmds:
-            cmd = self._n._exec_cmds[name]
-            t = self.target
-
-            def fn(inputs=None, variables=None):
-                return cmd(t, inputs=inputs, variables=variables)
-            return fn
-        else:
-            raise AttributeError
-
     def phony(self, inputs):
-        self._n._seq.append(_NPhony(self.target, self._n.files(inputs)))
+        v = _NPhony(self.target, self._n.files(inputs))
+        self._n._add_edge('phony', [v.name], v.inputs)
+        self._n._emit(v)
         return self
 
     def __repr__(self):
@@ -243,35 +1067,30 @@ class _Target(object):
 
 
 class _Files(object):
+    """Build commands are added as methods to a subclass made for each Ninju
+    object (see Ninju.cmd).
+
+    files is a flat tuple. It is never modified, so it is shared instead of
+    copied when a _Files is made from a single other _Files.
+    """
+    __slots__ = ('_n', 'files')
+
     def __init__(self, ninju, *files):
         super(_Files, self).__init__()
         self._n = ninju
         self.files = _flatten(files)
 
-    def __getattr__(self, name):
-        if name in self._n._cmds:
-            cmd = self._n._cmds[name]
-            p = self.files
-
-            def fn(outputs=None, implicit=None, order_only=None,
-                    variables=None, implicit_outputs=None):
-                return cmd(p, outputs=outputs, implicit=implicit, order_only=order_only,
-                           variables=variables, implicit_outputs=implicit_outputs)
-            return fn
-        else:
-            raise AttributeError
-
     def __repr__(self):
-        return self.files.__repr__()
+        return list(self.files).__repr__()
 
     def __str__(self):
-        return self.files.__str__()
+        return list(self.files).__str__()
 
     def __bytes__(self):
-        return self.files.__bytes__()
+        return list(self.files).__bytes__()
 
     def __format__(self, format_spec):
-        return self.files.__format__(format_spec)
+        return list(self.files).__format__(format_spec)
 
     def __iter__(self):
         return self.files.__iter__()
@@ -279,27 +1098,111 @@ class _Files(object):
     def __next__(self):
         return self.files.__next__()
 
+    def batch(self, cmd, size, outputs=None, implicit=None, order_only=None,
+              variables=None):
+        """Runs the batchable command cmd on the files, up to size files per
+        build statement (see Ninju.cmd).
+
+        outputs has one path for each file, generated names are used when it
+        is not given.
+        """
+        fn = self._n._batch_cmds.get(cmd)
+        if fn == None:
+            raise ConfigurationError('command is not batchable: {}'.format(cmd))
+        return fn(self.files, size, outputs=outputs, implicit=implicit,
+                  order_only=order_only, variables=variables)
+
 
 class Ninju(object):
     """
     cwd_check is used only in test to bypass CWD check.
+
+    When stream is True, statements declared after initialization are
+    serialized right away into a spooled buffer (kept in memory up to
+    spool_size characters) instead of being kept as objects until generate().
+    Streamed edges are not indexed, so graph, check(), the exports, snapshots,
+    record_sites and stable_names cannot be used, and duplicate outputs are
+    not detected.
+
+    Lines are wrapped at width columns, or never when width is None.
+
+    script is the generator script that is run by the configure rule and
+    root is the directory where the build file is written. They default to
+    the file of the calling module and its directory.
+
+    resolver is used to find executables (see ExeResolver). By default a
+    resolver shared by all Ninju objects in the process is used.
+
+    When shards is set, build statements are spread over that many files
+    (build.1.ninja, build.2.ninja, ... next to the build file) which the
+    build file includes. Only files whose content changed are rewritten.
+
+    resources overrides the number of cores ('cpu') and megabytes of memory
+    ('mem_mb') used to compute the depth of the pools of commands declared
+    with resource hints. By default they are read from the machine.
+
+    When stable_names is True, generated file names are derived from a hash
+    of the rule, inputs and variables of the edge producing them instead of
+    a counter, so they do not change when unrelated edges are added.
+
+    When record_sites is True, the file and line declaring each edge are
+    recorded, and generate() writes them with the graph to
+    $builddir/.ninju_graph.json for `python ninju.py profile`.
     """
 
-    def __init__(self, build_file='build.ninja', build_dir='.builddir', generators=[], no_cwd_check=False):
+    def __init__(self, build_file='build.ninja', build_dir='.builddir', generators=[], no_cwd_check=False,
+                 stream=False, spool_size=8 * 1024 * 1024, width=78, root=None, script=None,
+                 resolver=None, shards=None, stable_names=False, resources=None,
+                 record_sites=False):
         super(Ninju, self).__init__()
+        if shards is not None and (not isinstance(shards, int) or shards < 1):
+            raise ConfigurationError('shards must be an integer greater than 0')
+        if shards and stream:
+            raise ConfigurationError('shards cannot be used with stream')
+        if record_sites and stream:
+            raise ConfigurationError('record_sites cannot be used with stream')
+        if stable_names and stream:
+            # Colliding names are found in the graph, which stream does not keep.
+            raise ConfigurationError('stable_names cannot be used with stream')
         self._build_file = build_file
         self._build_dir = build_dir
+        self._shards = shards
+        self._stable_names = stable_names
+        self._resource_overrides = resources or {}
+        self._width = width
+        self._resolver = resolver if resolver is not None else _default_resolver
         self._seq = []
+        self._stream = None
         self._name_count = 0
         self._cmds = {}
+        self._batch_cmds = {}
         self._exec_cmds = {}
+        self._rules = {}
+        self._section = None
+        self._files_cls = type('_Files', (_Files,), {'__slots__': ()})
+        self._target_cls = type('_Target', (_Target,), {'__slots__': ()})
         self._pools = {}
-        self._vars = {}
-
-        frame = inspect.stack()[1]
-        module = inspect.getmodule(frame[0])
-        self._file = os.path.abspath(module.__file__)
-        self._root_dir = os.path.dirname(self._file)
+        self._expander = ninja_syntax.Expander()
+        self._vars = self._expander.vars
+        self._store = _EdgeStore()
+        self._graph = BuildGraph(self._store)
+        self._run = None
+        self._scanned_dirs = set()
+        self._section_dirs = None
+        self._sites = [] if record_sites else None
+        self._executor = None
+        self._deferred = []
+
+        if script is None:
+            script = _caller_globals(1).get('__file__')
+            if script is None:
+                raise ConfigurationError(
+                    'cannot find the generator script, specify it using script')
+        self._file = os.path.abspath(script)
+        if root is None:
+            self._root_dir = os.path.dirname(self._file)
+        else:
+            self._root_dir = os.path.abspath(root)
 
         if not no_cwd_check and self._root_dir != os.getcwd():
             print('Cannot run from outside directory "{}"'.format(self._root_dir))
@@ -317,12 +1220,34 @@ class Ninju(object):
             NINJA_SYNTAX_MODULE_PATH]
         for g in generators:
             gens.append(g.__file__)
-
-        self.files().configure(self.root(self._build_file),
-                               implicit=gens)
+        self._generator_files = [self._file] + gens
+        self._generators_digest = None
+
+        shard_files = []
+        if shards:
+            stem, ext = os.path.splitext(self._build_file)
+            for i in range(shards):
+                shard_files.append('{}.{}{}'.format(stem, i + 1, ext))
+        self._shard_files = shard_files
+
+        # Not stored with the other edges, as glob() adds inputs to it.
+        b = _NBuild(
+            self.root(self._build_file).files,
+            'configure',
+            implicit=self.files(self._rules['configure'].executable, gens),
+            implicit_outputs=[os.path.join('${root}', f) for f in shard_files])
+        self._add_edge('configure',
+                       _flatten([b.outputs, b.implicit_outputs]), b.implicit)
+        self._emit(b)
+        self._configure_build = b
+
+        if stream:
+            self._stream = _NStream(spool_size, width)
 
     """returns a directory function.
     If var is specified it also create a new variable.
+    The glob(pattern) attribute of the directory function returns the files
+    in the directory matching pattern (see _glob).
     """
 
     def dir(self, *args, var=None):
@@ -337,33 +1262,63 @@ class Ninju(object):
 
         _self = self
 
+        prefix = _prefix(p)
+
         def dirfn(*args):
-            return _Files(_self, os.path.join(p, *args))
+            return _self._files_cls(_self, _join(p, prefix, args))
+
+        def glob(pattern):
+            return _self._glob(p, pattern)
+        dirfn.glob = glob
         return dirfn
 
     def root(self, *args):
-        return _Files(self, os.path.join('${root}', *args))
+        return self._files_cls(self, _join('${root}', '${root}/', args))
 
     def builddir(self, *args):
-        return _Files(self, os.path.join('${builddir}', *args))
+        return self._files_cls(self, _join('${builddir}', '${builddir}/', args))
 
     def var(self, key, value):
         v = _NVar(key, value)
-        self._seq.append(v)
-        expval = Template(value).substitute(self._vars)
-        self._vars[key] = expval
+        self._emit(v)
+        self._expander.define(key, self._expander.expand(value))
         return "${" + key + "}"
 
     def cmd(self, name, executable, args=None, description=None, depfile=None,
             generator=False, pool=None, restat=False, rspfile=None,
-            rspfile_content=None, deps=None):
+            rspfile_content=None, deps=None, cpu=None, mem_mb=None,
+            batchable=False):
+        """Declares a build command.
+
+        cpu and mem_mb are the number of cores and megabytes of memory used
+        by one run of the command. Commands with the same hints share a pool
+        whose depth is derived from the resources of the machine when the
+        build file is generated (see Ninju resources). They cannot be used
+        together with pool.
+
+        A batchable command can be run on many files at once with
+        _Files.batch(). Each build statement then has one output for each
+        input, in the same order, and the inputs are written one per line to
+        a response file unless rspfile_content is given.
+        """
+        if pool != None and (cpu != None or mem_mb != None):
+            raise ConfigurationError('pool cannot be used with cpu or mem_mb')
+        if batchable:
+            if rspfile != None:
+                raise ConfigurationError('rspfile cannot be used with batchable')
+            rspfile = '${ninju_rsp}'
+            if rspfile_content == None:
+                rspfile_content = '${in_newline}'
         r = self._find_exe(executable)
         exe = r[1]
         if not r[0]:
             warnings.warn('executable not found: {}'.format(exe),
                           NinjuWarning, stacklevel=2)
 
-        pool_name = self._setup_pool(pool)
+        if cpu != None or mem_mb != None:
+            pool_name = self._setup_resource_pool(cpu, mem_mb)
+        else:
+            pool_name = self._setup_pool(pool)
         v = _NBuildRule(
             name,
             exe,
@@ -376,8 +1331,13 @@ class Ninju(object):
             rspfile=rspfile,
             rspfile_content=rspfile_content,
             deps=deps)
-        self._seq.append(v)
-        self._cmds[name] = v.build_fn(self)
+        fn = v.build_fn(self)
+        _add_method(self._files_cls, name, _files_method(fn))
+        self._emit(v)
+        self._rules[name] = v
+        self._cmds[name] = fn
+        if batchable:
+            self._batch_cmds[name] = v.batch_fn(self)
 
     def exec_cmd(self, name, executable, args=None, description=None,
                  rspfile=None, rspfile_content=None):
@@ -394,27 +1354,430 @@ class Ninju(object):
             description=description,
             rspfile=rspfile,
             rspfile_content=rspfile_content)
-        self._seq.append(v)
-        self._exec_cmds[name] = v.exec_fn(self)
+        fn = v.exec_fn(self)
+        _add_method(self._target_cls, name, _target_method(fn))
+        self._emit(v)
+        self._rules[name] = v
+        self._exec_cmds[name] = fn
+
+    def acmd(self, name, executable, *args, **kwargs):
+        """Like cmd(), but the executable is looked up on a thread pool while
+        the script goes on.
+
+        Returns a Deferred (see later()). The command is declared where acmd()
+        was called, and can be used once the Deferred is awaited.
+        """
+        # The resolver remembers the result, so cmd() does not look it up
+        # again. The path is the one _find_exe() resolves.
+        ff = self.files(executable)
+        if len(ff.files) != 1:
+            raise ConfigurationError('Only one executable required')
+        path = self._expander.expand(str(ff.files[0]))
+        future = self.submit(self._resolver.resolve, path)
+        return self.later(
+            future, lambda found: self.cmd(name, executable, *args, **kwargs))
+
+    def submit(self, fn, *args, **kwargs):
+        """Runs fn on a thread pool and returns a concurrent.futures.Future.
+
+        fn must not declare statements, use later() to declare statements
+        from its result.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor()
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def later(self, future, fn):
+        """Declares statements from the result of a future.
+
+        fn is called with the result of the concurrent.futures.Future future
+        and declares its statements where later() was called, so the build
+        file does not depend on when the future finishes. It is called when
+        the returned Deferred is awaited or resolved, and at the latest by
+        generate(). Cannot be used with stream or in a section.
+        """
+        if self._stream is not None:
+            raise ConfigurationError('later cannot be used with stream')
+        if self._section is not None:
+            raise ConfigurationError('later cannot be used in a section')
+        slot = _NSlot()
+        self._emit(slot)
+        d = Deferred(self, slot, future, fn)
+        self._deferred.append(d)
+        return d
+
+    def _resolve(self, last=None):
+        """Resolves the Deferred objects in declaration order, up to last or
+        all of them. Cannot be done in a section, whose cached edges would
+        include the statements of the Deferred objects."""
+        if self._deferred and self._section is not None:
+            raise ConfigurationError(
+                'Deferred objects cannot be resolved in a section')
+        while self._deferred:
+            d = self._deferred.pop(0)
+            d._run()
+            if d is last:
+                return
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if any(isinstance(task, _NSlot) for task in self._seq):
+            self._seq = _splice(self._seq)
 
     def _gen_name(self, ext='tmp'):
         self._name_count += 1
         return '${builddir}' + ('/.ninju_{index}.{ext}'.format(ext=ext, index=self._name_count))
 
-    def generate(self, newline=True):
-        output = open(os.path.join(self._root_dir, self._build_file), 'w')
-        w = self._generate(output, newline)
-        w.close()
+    def _name_generator(self, rule, inputs, implicit, order_only, variables):
+        """Returns the function naming the generated outputs of an edge."""
+        if not self._stable_names:
+            return self._gen_name
+
+        # The edge is only hashed when a name is generated, most edges
+        # having explicit outputs.
+        h = []
+        index = [0]
+
+        def gen_name(ext='tmp'):
+            if not h:
+                h.append(_edge_hash(rule, inputs, implicit, order_only, variables))
+            index[0] += 1
+            hi = h[0].copy()
+            hi.update(str(index[0]).encode('utf-8'))
+            digest = hi.hexdigest()[:16]
+            name = '${builddir}/.ninju_' + digest
+            n = 1
+            while self._graph.producer(name + '.' + ext) is not None:
+                n += 1
+                name = '${{builddir}}/.ninju_{}-{}'.format(digest, n)
+            return name + '.' + ext
+        return gen_name
+
+    def generate(self, newline=True, jobs=None, check=False, exports=None,
+                 optimize=False, snapshot=False):
+        """Writes the build file.
+
+        The build file is left untouched when its content did not change.
+        Returns True if the build file was written.
+
+        When jobs is greater than 1, build statements are formatted in that
+        many worker processes (threads on free-threaded Python builds). The
+        output is the same as without jobs. Processes are forked, so
+        statements are formatted serially on platforms without fork. With
+        optimize, statements are always formatted serially, as they are
+        rewritten.
+
+        When check is True, the graph is checked first (see check()).
+
+        exports maps 'compdb', 'dot' or 'edges' to a path, relative to the
+        root directory, where the output of export_compdb(), export_dot() or
+        export_edges() is written.
+
+        When optimize is True, the build file is made smaller without changing
+        its meaning (see _optimize()).
+
+        When snapshot is True, the graph, rules, pools and variables are also
+        written to the build file name followed by SNAPSHOT_SUFFIX, to be read
+        by load_snapshot().
+        """
+        exporters = {
+            'compdb': self.export_compdb,
+            'dot': self.export_dot,
+            'edges': self.export_edges,
+        }
+        exports = exports or {}
+        for kind in exports:
+            if kind not in exporters:
+                raise ConfigurationError('unknown export: {}'.format(kind))
+
+        self._resolve()
+        if snapshot and self._stream is not None:
+            raise ConfigurationError('snapshot cannot be used with stream')
+        if check:
+            self.check()
+        path = os.path.join(self._root_dir, self._build_file)
+
+        if self._shards:
+            written = self._generate_shards(newline, jobs, optimize)
+        else:
+            def write(output):
+                self._generate(output, newline, jobs, optimize)
+            written = _write_if_changed(path, write)
+        for kind, f in sorted(exports.items()):
+            _write_if_changed(os.path.join(self._root_dir, f), exporters[kind])
+        if snapshot:
+            _write_if_changed(path + SNAPSHOT_SUFFIX, self._write_snapshot,
+                              binary=True)
+        if self._sites is not None:
+            self._write_sites()
+        if isinstance(self._resolver, ExeResolver):
+            self._resolver.save()
+        return written
+
+    @property
+    def graph(self):
+        """The BuildGraph of the edges declared so far. Not available with
+        stream."""
+        if self._stream is not None:
+            raise ConfigurationError('graph cannot be used with stream')
+        return self._graph
+
+    def check(self, dangling=True):
+        """Raises GeneratorError if the graph has a dependency cycle, or if
+        dangling is True and an input is neither produced by an edge nor an
+        existing file. Cannot be used with stream."""
+        if self._stream is not None:
+            raise ConfigurationError('check cannot be used with stream')
+        cycle = self._graph.find_cycle()
+        if cycle:
+            raise GeneratorError(
+                'dependency cycle: {}'.format(' -> '.join(cycle)))
+
+        if dangling:
+            missing = []
+            for i in self._graph.sources():
+                p = self._expander.expand(i)
+                if not os.path.exists(os.path.join(self._root_dir, p)):
+                    missing.append(i)
+            if missing:
+                raise GeneratorError(
+                    'inputs not produced by any edge and not found: {}'.format(
+                        ', '.join(sorted(missing))))
 
     def files(self, *args):
-        return _Files(self, *args)
+        return self._files_cls(self, *args)
 
     def target(self, target):
-        return _Target(self, target)
+        return self._target_cls(self, target)
 
     def default(self, *targets):
         v = _NDefault(self.files(*targets))
-        self._seq.append(v)
+        self._emit(v)
+
+    def _add_build(self, outputs, rule, inputs=None, implicit=None, order_only=None,
+                   variables=None, implicit_outputs=None):
+        """Adds a build statement to the graph and emits it."""
+        if self._stream is not None:
+            # Not indexed, so that memory does not grow with the edges.
+            self._emit(_NBuild(
+                list(_flatten(outputs)), rule, inputs=list(_flatten(inputs)),
+                implicit=list(_flatten(implicit)),
+                order_only=list(_flatten(order_only)), variables=variables,
+                implicit_outputs=list(_flatten(implicit_outputs))))
+            return
+        index = self._store.add(
+            rule, (outputs, implicit_outputs, inputs, implicit, order_only),
+            variables)
+        if self._sites is not None:
+            self._sites.append(_call_site())
+        run = self._run
+        if run is not None and run.stop == index and self._seq and self._seq[-1] is run:
+            run.stop += 1
+        else:
+            self._run = _NEdges(self._store, index, index + 1)
+            self._emit(self._run)
+
+    def _add_edge(self, rule, outputs, inputs):
+        if self._stream is not None:
+            return
+        self._graph.add(rule, outputs, inputs)
+        if self._sites is not None:
+            self._sites.append(_call_site())
+
+    def section(self, name, fn=None, key=None, files=None):
+        """Declares a section of the graph whose statements are cached.
+
+        fn is called without arguments to declare the build, phony and default
+        statements of the section; it cannot declare variables or commands.
+        The formatted statements are cached in $builddir together with a
+        fingerprint of the section: the code of fn and the values it refers
+        to, key, the size and mtime of files, the content of the script and
+        generators, and the commands declared so far. When the fingerprint
+        is unchanged, fn is not called and the cached statements are used
+        instead. Directories globbed by fn are cached too, and the section
+        runs again when one of them changes.
+
+        Returns what fn returns, which may be built from _Files, lists,
+        tuples, dicts, strings and numbers. Without fn, returns a decorator
+        that runs the section and replaces the function with its result.
+        """
+        if fn is None:
+            return lambda fn: self.section(name, fn, key=key, files=files)
+
+        if self._stream is not None:
+            raise ConfigurationError('section cannot be used with stream')
+        if self._section is not None:
+            raise ConfigurationError('sections cannot be nested')
+        if not re.match(r'^[A-Za-z0-9_.-]+$', name):
+            raise ConfigurationError('invalid section name: {}'.format(name))
+
+        path = os.path.join(self._root_dir, self._build_dir,
+                            '.ninju_sections', name + '.json')
+        fingerprint = self._section_fingerprint(name, fn, key, files)
+        cached = _load_section(path, fingerprint)
+        if cached is not None and self._dirs_changed(cached.get('dirs', ())):
+            cached = None
+        if cached is not None:
+            for d, mtime in cached.get('dirs', ()):
+                self._add_scanned_dir(d)
+            for edge in cached['edges']:
+                self._add_edge(*edge)
+            for k, text in cached['statements']:
+                self._seq.append(_NRaw(text, k))
+            self._name_count += cached['names']
+            return self._decode_section_result(cached['result'])
+
+        seq_start = len(self._seq)
+        graph_start = len(self._graph)
+        name_count = self._name_count
+        self._section = name
+        self._section_dirs = {}
+        self._run = None
+        try:
+            result = fn()
+        finally:
+            self._section = None
+            dirs = self._section_dirs
+            self._section_dirs = None
+            self._run = None
+
+        statements = []
+        for task in _statements(self._seq[seq_start:]):
+            output = io.StringIO()
+            task.write(ninja_syntax.Writer(output, self._width))
+            if isinstance(task, _NBuild):
+                k = str(task.outputs[0])
+            elif isinstance(task, _NPhony):
+                k = str(task.name)
+            else:
+                k = None
+            statements.append((k, output.getvalue()))
+        self._seq[seq_start:] = [_NRaw(text, k) for k, text in statements]
+
+        try:
+            encoded = _encode_section_result(result)
+        except TypeError as e:
+            warnings.warn('section {} is not cached: {}'.format(name, e),
+                          NinjuWarning, stacklevel=2)
+            return result
+
+        data = {
+            'fingerprint': fingerprint,
+            'statements': statements,
+            'edges': [list(self._graph._edge(i))
+                      for i in range(graph_start, len(self._graph))],
+            'names': self._name_count - name_count,
+            'dirs': sorted(dirs.items()),
+            'result': encoded,
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_if_changed(path, lambda output: json.dump(data, output))
+        return result
+
+    def _section_fingerprint(self, name, fn, key, files):
+        h = hashlib.sha256()
+        rules = sorted((n, r.executable, r.args)
+                       for n, r in self._rules.items())
+        h.update(repr([NINJU_VERSION, name, key, self._width,
+                       self._stable_names, self._name_count,
+                       rules]).encode('utf-8'))
+        # Modules used by fn are only fingerprinted by name, so sections also
+        # depend on the files the configure edge depends on.
+        if self._generators_digest is None:
+            g = hashlib.sha256()
+            for f in self._generator_files:
+                try:
+                    g.update(_file_digest(f))
+                except OSError:
+                    g.update(repr((f, None)).encode('utf-8'))
+            self._generators_digest = g.digest()
+        h.update(self._generators_digest)
+        _fingerprint_value(h, fn, set())
+        for f in _flatten(files):
+            p = os.path.join(self._root_dir,
+                             self._expander.expand(str(f)))
+            try:
+                st = os.stat(p)
+                h.update(repr((str(f), st.st_size, st.st_mtime_ns)).encode('utf-8'))
+            except OSError:
+                h.update(repr((str(f), None)).encode('utf-8'))
+        return h.hexdigest()
+
+    def _dirs_changed(self, dirs):
+        """Returns True if one of the directories globbed by a cached section
+        changed since, as its cached statements are then outdated."""
+        for path, mtime in dirs:
+            try:
+                if os.stat(self._real_dir(path)).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def _decode_section_result(self, v):
+        if isinstance(v, list):
+            return [self._decode_section_result(x) for x in v]
+        if isinstance(v, dict):
+            if 'files' in v:
+                return self.files(v['files'])
+            if 'tuple' in v:
+                return tuple(self._decode_section_result(x) for x in v['tuple'])
+            return dict((k, self._decode_section_result(x)) for k, x in v['dict'])
+        return v
+
+    def _glob(self, path, pattern):
+        """Returns the files in directory path matching pattern, sorted by name.
+
+        pattern may start with subdirectories, e.g. 'sub/*.csv', but only the
+        last component can contain wildcards. Names starting with '.' only
+        match patterns starting with '.'. The directory is added as an implicit
+        dependency of the configure rule, so adding or removing a file
+        regenerates the build file.
+        """
+        subdir, pattern = os.path.split(pattern)
+        if fnmatch.filter([subdir], '*[[*?]*'):
+            raise ConfigurationError(
+                'only the last component of a glob pattern can contain wildcards')
+        if subdir:
+            path = os.path.join(path, subdir)
+
+        real = self._real_dir(path)
+        try:
+            names = _scan_dir(real)
+        except OSError:
+            raise ConfigurationError('directory not found: {}'.format(path))
+        if not pattern.startswith('.'):
+            names = [f for f in names if not f.startswith('.')]
+
+        self._add_scanned_dir(path)
+        if self._section_dirs is not None:
+            # Replayed when the section is cached, see section().
+            self._section_dirs[path] = _scan_cache[real][0]
+        return self.files([os.path.join(path, f)
+                           for f in fnmatch.filter(names, pattern)])
+
+    def _real_dir(self, path):
+        return os.path.normpath(os.path.join(
+            self._root_dir, self._expander.expand(path)))
+
+    def _add_scanned_dir(self, path):
+        """Adds directory path as an implicit dependency of the configure
+        rule."""
+        if path not in self._scanned_dirs:
+            self._scanned_dirs.add(path)
+            b = self._configure_build
+            b.implicit = self.files(b.implicit, path)
+
+    def _emit(self, task):
+        if self._section is not None and not (
+                isinstance(task, _NBuild) or isinstance(task, _NEdges)
+                or isinstance(task, _NPhony) or isinstance(task, _NDefault)):
+            raise ConfigurationError(
+                'only build, phony and default statements can be declared in a section')
+        if self._stream is None:
+            self._seq.append(task)
+        else:
+            self._stream.write(task)
 
     def _find_exe(self, path):
         ff = self.files(path)
@@ -422,16 +1785,13 @@ class Ninju(object):
             raise ConfigurationError('Only one executable required')
 
         fpath = ff.files[0]
-        fp = Template(str(fpath)).substitute(self._vars)
-        if os.path.isfile(fp) and os.access(fp, os.X_OK):
-            return (True, fpath)
-        try:
-            p = shutil.which(fp)
-            if p == None:
-                return (False, fpath)
-            return (True, p)
-        except Exception:
+        fp = self._expander.expand(str(fpath))
+        p = self._resolver.resolve(fp)
+        if p == None:
             return (False, fpath)
+        if p == fp:
+            return (True, fpath)
+        return (True, p)
 
     def _setup_pool(self, pool):
         if pool == None:
@@ -443,8 +1803,9 @@ class Ninju(object):
                     'pool must be an integer greater than 1 or \'console\'')
             pool_name = 'pool_{}'.format(pool)
             if not (pool_name in self._pools):
-                self._seq.append(_NPool(pool_name, pool))
-                self._pools[pool_name] = True
+                v = _NPool(pool_name, pool)
+                self._emit(v)
+                self._pools[pool_name] = v
             return pool_name
 
         if pool == 'console':
@@ -453,18 +1814,789 @@ class Ninju(object):
         raise ConfigurationError(
             'pool must be an integer greater than 1 or \'console\'')
 
-    def _generate(self, output, newline=True):
-        writer = ninja_syntax.Writer(output)
+    def _resources(self):
+        resources = _machine_resources()
+        resources.update(self._resource_overrides)
+        return resources
+
+    def _setup_resource_pool(self, cpu, mem_mb):
+        if cpu == None:
+            cpu = 1
+        if not isinstance(cpu, int) or cpu < 1:
+            raise ConfigurationError('cpu must be an integer greater than 0')
+        if mem_mb != None and (not isinstance(mem_mb, int) or mem_mb < 1):
+            raise ConfigurationError('mem_mb must be an integer greater than 0')
+
+        pool_name = 'pool_cpu{}'.format(cpu)
+        if mem_mb != None:
+            pool_name += '_mem{}'.format(mem_mb)
+        if not (pool_name in self._pools):
+            v = _NResourcePool(pool_name, cpu, mem_mb, self._resources)
+            self._emit(v)
+            self._pools[pool_name] = v
+        return pool_name
+
+    def export_compdb(self, output):
+        """Writes a compilation database (compile_commands.json) of the build
+        statements to output, like `ninja -t compdb`.
+
+        Statements of cached sections are not included, and it cannot be used
+        with stream.
+        """
+        if self._stream is not None:
+            raise ConfigurationError('export_compdb cannot be used with stream')
+        rules = self._rules
+        output.write('[')
+        first = True
+        for task in _statements(self._seq):
+            if not isinstance(task, _NBuild) or task is self._configure_build:
+                continue
+            rule = rules.get(task.rule)
+            if rule is None:
+                continue
+            inputs = [self._expand_path(str(i)) for i in _flatten(task.inputs)]
+            outputs = [self._expand_path(str(o)) for o in _flatten(task.outputs)]
+            command = rule.executable
+            if rule.args != None:
+                command = ' '.join([command, rule.args])
+            entry = {
+                'directory': self._root_dir,
+                'command': self._expand_command(command, inputs, outputs, task.variables),
+                'file': inputs[0] if inputs else '',
+                'output': outputs[0],
+            }
+            output.write('\n  ' if first else ',\n  ')
+            output.write(json.dumps(entry, sort_keys=True))
+            first = False
+        output.write('\n]\n')
+
+    def export_dot(self, output):
+        """Writes the graph in Graphviz DOT format to output, like
+        `ninja -t graph`. Cannot be used with stream."""
+        if self._stream is not None:
+            raise ConfigurationError('export_dot cannot be used with stream')
+        output.write('digraph ninja {\n')
+        output.write('rankdir="LR"\n')
+        output.write('node [fontsize=10, shape=box, height=0.25]\n')
+        output.write('edge [fontsize=10]\n')
+        nodes = {}
+
+        def node(path):
+            n = nodes.get(path)
+            if n is None:
+                n = nodes[path] = 'n{}'.format(len(nodes))
+                output.write('{} [label={}]\n'.format(n, json.dumps(path)))
+            return n
+
+        for index, edge in enumerate(self._graph):
+            ins = [node(i) for i in edge.inputs]
+            outs = [node(o) for o in edge.outputs]
+            label = json.dumps(edge.rule)
+            if len(ins) == 1 and len(outs) == 1:
+                output.write('{} -> {} [label={}]\n'.format(ins[0], outs[0], label))
+                continue
+            e = 'e{}'.format(index)
+            output.write('{} [label={}, shape=ellipse]\n'.format(e, label))
+            for i in ins:
+                output.write('{} -> {} [arrowhead=none]\n'.format(i, e))
+            for o in outs:
+                output.write('{} -> {}\n'.format(e, o))
+        output.write('}\n')
+
+    def export_edges(self, output):
+        """Writes one JSON object per edge to output, with its rule, outputs
+        and inputs (including implicit and order-only dependencies). Cannot be
+        used with stream."""
+        if self._stream is not None:
+            raise ConfigurationError('export_edges cannot be used with stream')
+        for edge in self._graph:
+            output.write(json.dumps(
+                {'rule': edge.rule, 'outputs': edge.outputs, 'inputs': edge.inputs}))
+            output.write('\n')
+
+    def _expand_command(self, command, inputs, outputs, variables):
+        """Returns the command of a build statement as ninja runs it."""
+        scope = {
+            'in': ' '.join(_shell_quote(i) for i in inputs),
+            'in_newline': '\n'.join(inputs),
+            'out': ' '.join(_shell_quote(o) for o in outputs),
+        }
+        if isinstance(variables, dict):
+            variables = variables.items()
+        # As in ninja, edge variables only see the top-level variables.
+        for key, value in variables or ():
+            if isinstance(value, list):
+                value = ' '.join(filter(None, value))
+            scope[key] = self._expander.expand(str(value))
+        return ninja_syntax.expand(command, self._vars, scope)
+
+    def _expand_path(self, path):
+        """Returns path as ninja sees it, relative to the root directory."""
+        return os.path.normpath(self._expander.expand(path))
+
+    @staticmethod
+    def load_snapshot(path='build.ninja' + SNAPSHOT_SUFFIX):
+        """Returns a Snapshot of the graph saved by generate(snapshot=True).
+
+        The file is memory mapped, and paths and edges are only read when
+        they are queried.
+        """
+        return Snapshot(path)
+
+    def _write_snapshot(self, output):
+        """Writes the snapshot read by Snapshot to the binary output.
+
+        The file is _SNAPSHOT_MAGIC, the length of a JSON header, the header
+        and the sections it lists, each aligned to 4 bytes.
+        """
+        store = self._store
+        if store._consumer_starts is None:
+            store._index_consumers()
+        paths = [p.encode('utf-8') for p in store.paths]
+        offsets = array('I', [0])
+        n = 0
+        for p in paths:
+            n += len(p)
+            offsets.append(n)
+        # UTF-8 keeps the order of code points, so the bytes are sorted too.
+        order = array('I', sorted(range(len(paths)), key=store.paths.__getitem__))
+        sections = [
+            ('path_offsets', offsets.tobytes()),
+            ('path_data', b''.join(paths)),
+            ('sorted_paths', order.tobytes()),
+            ('ids', store.ids.tobytes()),
+            ('ends', store.ends.tobytes()),
+            ('rule_ids', store.rule_ids.tobytes()),
+            ('variable_ids', store.variable_ids.tobytes()),
+            ('producers', store.producers.tobytes()),
+            ('consumer_starts', store._consumer_starts.tobytes()),
+            ('consumer_ids', store._consumer_ids.tobytes()),
+            ('variables', json.dumps(store._variables).encode('utf-8')),
+        ]
+        table = {}
+        offset = 0
+        for name, data in sections:
+            table[name] = [offset, len(data)]
+            offset = _align(offset + len(data))
+        header = json.dumps({
+            'version': 1,
+            'byteorder': sys.byteorder,
+            'rule_names': store._names,
+            'rules': dict((name, vars(r)) for name, r in self._rules.items()),
+            'pools': dict((name, p.depth) for name, p in self._pools.items()),
+            'vars': self._vars,
+            'sections': table,
+        }, sort_keys=True).encode('utf-8')
+
+        output.write(_SNAPSHOT_MAGIC)
+        output.write(len(header).to_bytes(4, 'little'))
+        output.write(header)
+        output.write(bytes(_align(len(header)) - len(header)))
+        for name, data in sections:
+            output.write(data)
+            output.write(bytes(_align(len(data)) - len(data)))
+
+    def _write_sites(self):
+        edges = []
+        for edge, site in zip(self._graph, self._sites):
+            edges.append({
+                'rule': edge.rule,
+                'outputs': [self._expand_path(o) for o in edge.outputs],
+                'inputs': [self._expand_path(i) for i in edge.inputs],
+                'site': site,
+            })
+        data = {'version': 1, 'edges': edges}
+        builddir = os.path.join(self._root_dir, self._build_dir)
+        os.makedirs(builddir, exist_ok=True)
+        _write_if_changed(os.path.join(builddir, GRAPH_FILE),
+                          lambda output: json.dump(data, output))
+
+    def _writer(self, output):
+        writer = ninja_syntax.Writer(output, self._width)
         writer.comment('This file is generated by Ninju v{} ({})'.format(
             NINJU_VERSION, NINJU_URL))
         writer.newline()
+        return writer
 
-        for task in self._seq:
-            task.write(writer)
-            if newline:
-                writer.newline()
+    def _generate(self, output, newline=True, jobs=None, optimize=False):
+        writer = self._writer(output)
+        tasks = self._optimize() if optimize else self._seq
+        _write_tasks(writer, tasks, newline, jobs)
+        if self._stream is not None:
+            self._stream.copy_to(output, newline)
         return writer
 
+    def _optimize(self):
+        """Returns the statements rewritten to make the build file smaller.
+
+        - Rules identical except for their name are merged into the first
+          one, unless a cached section uses them.
+        - Directories that appear in many build paths are replaced by a
+          ninju_pN variable declared right before the first statement
+          using it.
+        - Long edge variable values without '$' that are repeated are
+          replaced by a ninju_vN variable in the same way.
+        """
+        if self._stream is not None:
+            raise ConfigurationError('optimize cannot be used with stream')
+        tasks = list(_statements(self._seq))
+
+        # Identical rules
+        raw_rules = set()
+        for task in tasks:
+            if isinstance(task, _NRaw) and task.key is not None:
+                raw_rules.add(_raw_rule(task.text))
+        canonical = {}
+        renamed = {}
+        dropped = set()
+        for task in tasks:
+            if not isinstance(task, (_NBuildRule, _NExecRule)) or getattr(task, 'generator', False):
+                continue
+            key = (type(task), repr(sorted((k, v) for k, v in vars(task).items() if k != 'name')))
+            if key in canonical:
+                renamed[task.name] = canonical[key]
+                if task.name not in raw_rules:
+                    dropped.add(id(task))
+            else:
+                canonical[key] = task.name
+
+        # Repeated directories and variable values
+        count = {}
+        redefined = set()
+        defined = set()
+        for task in tasks:
+            if isinstance(task, _NVar):
+                if task.name in defined:
+                    redefined.add(task.name)
+                defined.add(task.name)
+            elif isinstance(task, _NBuild) or isinstance(task, _NPhony):
+                for p in _build_paths(task):
+                    i = p.rfind('/')
+                    if i > 0:
+                        d = ('p', p[:i])
+                        count[d] = count.get(d, 0) + 1
+                for k, v in _variable_items(task):
+                    if isinstance(v, str) and len(v) >= 16 and '$' not in v:
+                        count[('v', v)] = count.get(('v', v), 0) + 1
+
+        def worth(d, n):
+            kind, value = d
+            if n < 3:
+                return False
+            if kind == 'p':
+                if ' ' in value or ':' in value or '$$' in value:
+                    return False
+                if redefined.intersection(ninja_syntax.variables(value)):
+                    return False
+            # Each use saves the value minus the reference; the declaration
+            # costs the name and the value.
+            return n * (len(value) - len('${ninju_p0}')) > len(value) + 20
+
+        hoisted = dict((d, None) for d, n in count.items() if worth(d, n))
+        numbers = {'p': 0, 'v': 0}
+        result = []
+
+        def ref(d):
+            name = hoisted[d]
+            if name is None:
+                kind = d[0]
+                while True:
+                    numbers[kind] += 1
+                    name = 'ninju_{}{}'.format(kind, numbers[kind])
+                    if name not in self._vars:
+                        break
+                hoisted[d] = name
+                result.append(_NVar(name, d[1]))
+            return '${' + name + '}'
+
+        def path(p):
+            p = str(p)
+            i = p.rfind('/')
+            if i > 0 and ('p', p[:i]) in hoisted:
+                return ref(('p', p[:i])) + p[i:]
+            return p
+
+        def paths(files):
+            if files == None:
+                return None
+            return [path(p) for p in _flatten(files)]
+
+        for task in tasks:
+            if id(task) in dropped:
+                continue
+            if isinstance(task, _NBuild) and task is not self._configure_build:
+                variables = None
+                if task.variables:
+                    variables = []
+                    for k, v in _variable_items(task):
+                        if isinstance(v, str) and ('v', v) in hoisted:
+                            v = ref(('v', v))
+                        variables.append((k, v))
+                task = _NBuild(
+                    paths(task.outputs),
+                    renamed.get(task.rule, task.rule),
+                    inputs=paths(task.inputs),
+                    implicit=paths(task.implicit),
+                    order_only=paths(task.order_only),
+                    variables=variables,
+                    implicit_outputs=paths(task.implicit_outputs))
+            elif isinstance(task, _NPhony):
+                task = _NPhony(task.name, paths(task.inputs))
+            result.append(task)
+        return result
+
+    def _split_shards(self, tasks):
+        """Returns the statements of the build file and of each shard.
+
+        Build statements go to a shard chosen by a hash of their first output,
+        so they stay in the same shard when other statements change. The
+        shards are included after the other statements, and defaults come
+        last as their targets must be known.
+        """
+        head = []
+        defaults = []
+        shards = [[] for _ in self._shard_files]
+        defined = set()
+        sharded = False
+        for task in _statements(tasks):
+            if isinstance(task, _NBuild) and task is not self._configure_build:
+                key = str(task.outputs[0])
+            elif isinstance(task, _NPhony):
+                key = str(task.name)
+            elif isinstance(task, _NRaw) and task.key is not None:
+                key = task.key
+            else:
+                if isinstance(task, _NDefault) or isinstance(task, _NRaw):
+                    defaults.append(task)
+                    continue
+                if isinstance(task, _NVar):
+                    if sharded and task.name in defined:
+                        raise GeneratorError(
+                            'variable redefined after build statements cannot be sharded: {}'.format(task.name))
+                    defined.add(task.name)
+                head.append(task)
+                continue
+            i = zlib.crc32(key.encode('utf-8')) % len(shards)
+            shards[i].append(task)
+            sharded = True
+
+        for f in self._shard_files:
+            head.append(_NInclude(os.path.join('${root}', f)))
+        return head + defaults, shards
+
+    def _generate_shards(self, newline=True, jobs=None, optimize=False):
+        head, shards = self._split_shards(
+            self._optimize() if optimize else self._seq)
+        written = False
+        for f, tasks in zip(self._shard_files, shards):
+            def write(output):
+                _write_tasks(self._writer(output), tasks, newline, jobs)
+            if _write_if_changed(os.path.join(self._root_dir, f), write):
+                written = True
+
+        # The build file is written last so that it never includes a shard
+        # older than itself.
+        def write(output):
+            _write_tasks(self._writer(output), head, newline)
+        if _write_if_changed(os.path.join(self._root_dir, self._build_file), write):
+            written = True
+        return written
+
+
+def _write_tasks(writer, tasks, newline=True, jobs=None):
+    if jobs and jobs > 1 and _write_tasks_parallel(writer, tasks, newline, jobs):
+        return
+
+    for task in tasks:
+        if isinstance(task, _NEdges):
+            write = task.store.write
+            for index in range(task.start, task.stop):
+                write(writer, index)
+                if newline:
+                    writer.newline()
+            continue
+        task.write(writer)
+        if newline:
+            writer.newline()
+
+
+# Edge store formatted by the workers of _write_tasks_parallel().
+_worker_store = None
+
+
+def _write_tasks_parallel(writer, tasks, newline, jobs):
+    """Writes tasks, the stored edges being formatted by jobs workers.
+    Returns False without writing anything when workers cannot be used or
+    there are too few edges."""
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    if is_gil_enabled is not None and not is_gil_enabled():
+        def executor():
+            return ThreadPoolExecutor(jobs)
+    elif 'fork' in multiprocessing.get_all_start_methods():
+        # Forked workers inherit the edge store, so only edge indexes are
+        # sent to them. Other start methods run the main module again in
+        # each worker, which is the configure script. The fork context is
+        # used whatever the default start method of the process is.
+        def executor():
+            return ProcessPoolExecutor(
+                jobs, mp_context=multiprocessing.get_context('fork'))
+    else:
+        return False
+
+    # Arrays of consecutive stored edges, and the other statements
+    store = None
+    pieces = []
+    count = 0
+    for task in tasks:
+        if isinstance(task, _NEdges):
+            store = task.store
+            indexes = range(task.start, task.stop)
+        elif isinstance(task, _NEdge):
+            store = task._store
+            indexes = (task._index,)
+        else:
+            pieces.append(task)
+            continue
+        if not pieces or not isinstance(pieces[-1], array):
+            pieces.append(array('I'))
+        pieces[-1].extend(indexes)
+        count += len(indexes)
+    if count < 2 * _MIN_CHUNK:
+        return False
+
+    global _worker_store
+    _worker_store = store
+    size = max(_MIN_CHUNK, -(-count // (jobs * 4)))
+    try:
+        with executor() as executor:
+            parts = []
+            for piece in pieces:
+                if isinstance(piece, array):
+                    parts.extend(
+                        executor.submit(_format_edges, piece[i:i + size],
+                                        writer.width, newline)
+                        for i in range(0, len(piece), size))
+                else:
+                    parts.append(piece)
+            for part in parts:
+                if isinstance(part, Future):
+                    writer.output.write(part.result())
+                    continue
+                part.write(writer)
+                if newline:
+                    writer.newline()
+    finally:
+        _worker_store = None
+    return True
+
+
+def _format_edges(indexes, width, newline):
+    output = io.StringIO()
+    writer = ninja_syntax.Writer(output, width)
+    write = _worker_store.write
+    for index in indexes:
+        write(writer, index)
+        if newline:
+            writer.newline()
+    return output.getvalue()
+
+
+def _build_paths(task):
+    """Returns the paths of a build or phony statement, except its name."""
+    if isinstance(task, _NPhony):
+        return [str(p) for p in _flatten(task.inputs)]
+    return [str(p) for p in _flatten([task.outputs, task.implicit_outputs, task.inputs,
+                                      task.implicit, task.order_only])]
+
+
+def _variable_items(task):
+    variables = getattr(task, 'variables', None)
+    if not variables:
+        return []
+    if isinstance(variables, dict):
+        return list(variables.items())
+    return list(variables)
+
+
+def _raw_rule(text):
+    """Returns the rule name of a formatted build statement."""
+    line = re.sub(r' \$\n +', ' ', text.split('\n  ', 1)[0])
+    m = re.match(r'build (?:[^:$]|\$.)*: (\S+)', line)
+    return m.group(1) if m else None
+
+
+def _shell_quote(path):
+    """Quotes path like ninja does for $in and $out: in single quotes unless
+    all its characters are safe in a POSIX shell, or in double quotes when
+    it has a space or a double quote on Windows."""
+    if os.name == 'nt':
+        if ' ' not in path and '"' not in path:
+            return path
+        # Backslashes are doubled before a quote and at the end.
+        path = re.sub(r'(\\*)"', r'\1\1\\"', path)
+        return '"' + re.sub(r'(\\*)$', r'\1\1', path) + '"'
+    if _SHELL_SAFE.match(path):
+        return path
+    return "'" + path.replace("'", "'\\''") + "'"
+
+
+def _call_site():
+    """Returns 'file:line' of the innermost caller outside this module."""
+    module_globals = globals()
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals is module_globals:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return '{}:{}'.format(frame.f_code.co_filename, frame.f_lineno)
+
+
+def _caller_globals(depth):
+    """Returns the globals of the function depth frames above the caller.
+
+    Only that frame is looked at, unlike inspect.stack() which builds a
+    record with source context for every frame on the stack.
+    """
+    try:
+        frame = sys._getframe(depth + 1)
+    except AttributeError:
+        frame = inspect.currentframe()
+        for _ in range(depth + 1):
+            frame = frame.f_back
+    return frame.f_globals
+
+
+class _HashingOutput(object):
+    """File-like wrapper that hashes the UTF-8 text or the bytes written
+    through it."""
+
+    def __init__(self, output):
+        super(_HashingOutput, self).__init__()
+        self.output = output
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, s):
+        b = s.encode('utf-8') if isinstance(s, str) else s
+        self.hash.update(b)
+        self.size += len(b)
+        self.output.write(s)
+
+    def close(self):
+        pass
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.digest()
+
+
+def _write_if_changed(path, write, binary=False):
+    """Calls write(output) and stores the result in path. output takes
+    bytes when binary is True.
+
+    The content goes to a temporary file that is atomically renamed to path,
+    so readers never see a partially written file. When path already has the
+    same size and hash, it is left untouched and False is returned.
+    """
+    dirname, basename = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(
+        dir=dirname or '.', prefix='.' + basename + '.', suffix='.tmp')
+    try:
+        if binary:
+            f = os.fdopen(fd, 'wb')
+        else:
+            f = os.fdopen(fd, 'w', encoding='utf-8', newline='')
+        with f:
+            output = _HashingOutput(f)
+            write(output)
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+
+        if (st is not None and st.st_size == output.size
+                and _file_digest(path) == output.hash.digest()):
+            os.unlink(tmp)
+            return False
+
+        if st is not None:
+            mode = st.st_mode & 0o7777
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+        return True
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def _files_method(cmd):
+    def method(self, outputs=None, implicit=None, order_only=None,
+               variables=None, implicit_outputs=None):
+        return cmd(self.files, outputs=outputs, implicit=implicit, order_only=order_only,
+                   variables=variables, implicit_outputs=implicit_outputs)
+    return method
+
+
+def _target_method(cmd):
+    def method(self, inputs=None, variables=None):
+        return cmd(self.target, inputs=inputs, variables=variables)
+    return method
+
+
+def _add_method(cls, name, method):
+    if hasattr(cls.__mro__[1], name):
+        raise ConfigurationError('command name is reserved: {}'.format(name))
+    method.__name__ = name
+    setattr(cls, name, method)
+
+
+# Directory path -> (mtime, sorted names of the files in it)
+_scan_cache = {}
+
+
+def _scan_dir(path):
+    """Returns the sorted names of the files in path.
+
+    The directory is read with a single os.scandir() call, and the result is
+    reused as long as the mtime of the directory does not change.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _scan_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with os.scandir(path) as it:
+        names = sorted(e.name for e in it if e.is_file())
+    _scan_cache[path] = (mtime, names)
+    return names
+
+
+def _load_section(path, fingerprint):
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('fingerprint') != fingerprint:
+        return None
+    return data
+
+
+def _encode_section_result(v):
+    if v is None or isinstance(v, (str, int, float, bool)):
+        return v
+    if isinstance(v, _Files):
+        return {'files': _as_string_list(v.files)}
+    if isinstance(v, list):
+        return [_encode_section_result(x) for x in v]
+    if isinstance(v, tuple):
+        return {'tuple': [_encode_section_result(x) for x in v]}
+    if isinstance(v, dict):
+        return {'dict': [[k, _encode_section_result(x)] for k, x in v.items()]}
+    raise TypeError('cannot cache a result of type {}'.format(type(v).__name__))
+
+
+def _fingerprint_value(h, v, seen, depth=0):
+    """Adds a description of v to the hash h.
+
+    Functions are described by their code, defaults, closure and the globals
+    they use, so that a section is rerun when any of them changes. Values
+    that cannot be described are represented by their type only.
+    """
+    if v is None or isinstance(v, (str, bytes, int, float, bool)):
+        h.update(repr(v).encode('utf-8'))
+    elif isinstance(v, _Files):
+        h.update(repr(v).encode('utf-8'))
+    elif isinstance(v, (list, tuple)):
+        h.update(b'[')
+        for x in v:
+            _fingerprint_value(h, x, seen, depth)
+            h.update(b',')
+        h.update(b']')
+    elif isinstance(v, dict):
+        h.update(b'{')
+        for k in sorted(v, key=repr):
+            _fingerprint_value(h, k, seen, depth)
+            h.update(b':')
+            _fingerprint_value(h, v[k], seen, depth)
+            h.update(b',')
+        h.update(b'}')
+    elif inspect.isfunction(v) or inspect.ismethod(v):
+        if inspect.ismethod(v):
+            v = v.__func__
+        if id(v) in seen or depth > 4:
+            h.update(('<function {}>'.format(v.__qualname__)).encode('utf-8'))
+            return
+        seen.add(id(v))
+        _fingerprint_code(h, v.__code__)
+        _fingerprint_value(h, v.__defaults__, seen, depth + 1)
+        if v.__closure__:
+            for cell in v.__closure__:
+                try:
+                    value = cell.cell_contents
+                except ValueError:
+                    value = None
+                _fingerprint_value(h, value, seen, depth + 1)
+        for name in _code_names(v.__code__):
+            if name in v.__globals__:
+                h.update(name.encode('utf-8'))
+                _fingerprint_value(h, v.__globals__[name], seen, depth + 1)
+    else:
+        h.update(('<{}>'.format(type(v).__name__)).encode('utf-8'))
+
+
+def _fingerprint_code(h, code):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode('utf-8'))
+    h.update(repr(code.co_varnames).encode('utf-8'))
+    for c in code.co_consts:
+        if inspect.iscode(c):
+            _fingerprint_code(h, c)
+        elif isinstance(c, frozenset):
+            h.update(repr(sorted(c, key=repr)).encode('utf-8'))
+        else:
+            h.update(repr(c).encode('utf-8'))
+
+
+def _code_names(code):
+    names = list(code.co_names)
+    for c in code.co_consts:
+        if inspect.iscode(c):
+            names.extend(_code_names(c))
+    return names
+
+
+def _edge_hash(rule, inputs, implicit, order_only, variables):
+    if isinstance(variables, dict):
+        variables = sorted(variables.items())
+    elif variables is not None:
+        variables = list(variables)
+    parts = [rule]
+    for files in (inputs, implicit, order_only):
+        parts.append(_as_string_list(_flatten(files)))
+    parts.append(variables)
+    return hashlib.sha1(repr(parts).encode('utf-8'))
+
+
+def _single_path(path):
+    if isinstance(path, _Files):
+        if len(path.files) != 1:
+            raise ConfigurationError('only one path required')
+        path = path.files[0]
+    return str(path)
+
 
 def _normalize_outputs(outputs, gen_name, ext='tmp'):
     if not outputs:
@@ -474,7 +2606,7 @@ def _normalize_outputs(outputs, gen_name, ext='tmp'):
         for i in range(outputs):
             outs.append(gen_name(ext))
         return outs
-    elif type(outputs) == _Files:
+    elif isinstance(outputs, _Files):
         return outputs.files
     elif isinstance(outputs, list):
         return outputs
@@ -483,7 +2615,7 @@ def _normalize_outputs(outputs, gen_name, ext='tmp'):
 
 
 def _is_single_item(t):
-    return not ((type(t) == _Files and len(t.files) != 1)
+    return not ((isinstance(t, _Files) and len(t.files) != 1)
                 or ((isinstance(t, list) or isinstance(t, tuple)) and len(t) != 1))
 
 
@@ -496,32 +2628,218 @@ def _as_string_list(t):
     return l
 
 
+def _prefix(path):
+    return path if path.endswith('/') else path + '/'
+
+
+def _join(path, prefix, args):
+    """Returns os.path.join(path, *args). prefix is _prefix(path), so the
+    common case of a single relative name is a concatenation."""
+    if len(args) == 1:
+        name = args[0]
+        if isinstance(name, str) and name and name[0] != '/':
+            return prefix + name
+    return os.path.join(path, *args)
+
+
 def _flatten(l):
     if l == None:
-        return []
+        return ()
 
-    if not (isinstance(l, list) or isinstance(l, tuple) or type(l) == _Files):
-        return [l]
+    if isinstance(l, _Files):
+        return l.files
 
-    if type(l) == _Files:
-        l0 = l.files
-    else:
-        l0 = l
+    if not (isinstance(l, list) or isinstance(l, tuple)):
+        return (l,)
+
+    if len(l) == 1:
+        if isinstance(l[0], _Files):
+            return l[0].files
+        if isinstance(l[0], str):
+            return (l[0],)
 
-    return _flatten_list(l0)
+    return _flatten_list(l)
 
 
 def _flatten_list(l):
+    """Flattens nested lists, tuples and _Files without recursion."""
     result = []
-    for v in l:
-        if not (isinstance(v, list) or isinstance(v, tuple) or type(v) == _Files):
-            if v != None:
+    stack = []
+    it = iter(l)
+    while True:
+        for v in it:
+            if isinstance(v, _Files):
+                result.extend(v.files)
+            elif isinstance(v, list) or isinstance(v, tuple):
+                stack.append(it)
+                it = iter(v)
+                break
+            elif v is not None:
                 result.append(v)
-            continue
-
-        if type(v) == _Files:
-            l0 = v.files
         else:
-            l0 = v
-        result.extend(_flatten_list(l0))
-    return result
+            if not stack:
+                return tuple(result)
+            it = stack.pop()
+
+
+def read_ninja_log(path):
+    """Returns {output: (start_ms, end_ms)} of the last run recorded in a
+    .ninja_log file.
+
+    Entries are appended as edges finish, so a run starts where an entry ends
+    before the previous one. When an output appears more than once in the
+    last run, the last entry wins.
+    """
+    entries = {}
+    last_end = 0
+    with open(path, encoding='utf-8') as f:
+        header = f.readline()
+        if not header.startswith('# ninja log v'):
+            raise ExecutionError('not a ninja log: {}'.format(path))
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 4 or line.startswith('#'):
+                continue
+            start, end = int(fields[0]), int(fields[1])
+            if end < last_end:
+                entries = {}
+            last_end = end
+            entries[fields[3]] = (start, end)
+    return entries
+
+
+def profile(builddir):
+    """Matches the last ninja run recorded in builddir with the graph written
+    by generate() when record_sites is enabled.
+
+    Returns a dict with the critical path (the chain of edges with the
+    longest total duration) and the duration statistics of each rule.
+    """
+    graph_file = os.path.join(builddir, GRAPH_FILE)
+    try:
+        with open(graph_file, encoding='utf-8') as f:
+            edges = json.load(f)['edges']
+    except OSError:
+        raise ExecutionError(
+            'graph not found: {} (generate it with Ninju(record_sites=True))'.format(graph_file))
+    log = read_ninja_log(os.path.join(builddir, '.ninja_log'))
+
+    producers = {}
+    durations = []
+    for index, edge in enumerate(edges):
+        duration = None
+        for o in edge['outputs']:
+            producers[o] = index
+            if duration is None and o in log:
+                start, end = log[o]
+                duration = end - start
+        durations.append(duration)
+
+    # Longest path through the graph, processing edges in dependency order.
+    preds = []
+    pending = []
+    consumers = [[] for _ in edges]
+    for index, edge in enumerate(edges):
+        p = set(producers[i] for i in edge['inputs'] if i in producers)
+        p.discard(index)
+        preds.append(p)
+        pending.append(len(p))
+        for q in p:
+            consumers[q].append(index)
+
+    finish = [0] * len(edges)
+    via = [None] * len(edges)
+    ready = [index for index, n in enumerate(pending) if n == 0]
+    while ready:
+        index = ready.pop()
+        best = None
+        for q in preds[index]:
+            if best is None or finish[q] > finish[best]:
+                best = q
+        finish[index] = (durations[index] or 0) + (finish[best] if best is not None else 0)
+        via[index] = best
+        for c in consumers[index]:
+            pending[c] -= 1
+            if pending[c] == 0:
+                ready.append(c)
+
+    critical = []
+    if edges:
+        index = max(range(len(edges)), key=lambda i: finish[i])
+        while index is not None:
+            critical.append(index)
+            index = via[index]
+        critical.reverse()
+
+    per_rule = {}
+    for index, edge in enumerate(edges):
+        if durations[index] is not None:
+            per_rule.setdefault(edge['rule'], []).append(durations[index])
+    rules = []
+    for rule, values in per_rule.items():
+        values.sort()
+        rules.append({
+            'rule': rule,
+            'count': len(values),
+            'total_ms': sum(values),
+            'mean_ms': sum(values) / len(values),
+            'p95_ms': values[max(0, -(-len(values) * 95 // 100) - 1)],
+        })
+    rules.sort(key=lambda r: r['total_ms'], reverse=True)
+
+    return {
+        'critical_path': [{
+            'rule': edges[i]['rule'],
+            'output': edges[i]['outputs'][0] if edges[i]['outputs'] else None,
+            'duration_ms': durations[i],
+            'site': edges[i]['site'],
+        } for i in critical],
+        'critical_path_ms': finish[critical[-1]] if critical else 0,
+        'rules': rules,
+    }
+
+
+def format_profile(result, top=20):
+    lines = ['Critical path ({} ms):'.format(result['critical_path_ms'])]
+    for e in result['critical_path']:
+        lines.append('  {:>8} ms  {:<20} {}  ({})'.format(
+            e['duration_ms'] if e['duration_ms'] is not None else '-',
+            e['rule'], e['output'], e['site'] or 'unknown'))
+    lines.append('')
+    lines.append('{:<20} {:>7} {:>10} {:>10} {:>10}'.format(
+        'Rule', 'Count', 'Total ms', 'Mean ms', 'P95 ms'))
+    for r in result['rules'][:top]:
+        lines.append('{:<20} {:>7} {:>10} {:>10.1f} {:>10}'.format(
+            r['rule'], r['count'], r['total_ms'], r['mean_ms'], r['p95_ms']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='ninju')
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser(
+        'profile', help='report the critical path and rule durations of the last ninja run')
+    p.add_argument('builddir', nargs='?', default='.builddir',
+                   help='directory containing .ninja_log (default: .builddir)')
+    p.add_argument('--top', type=int, default=20,
+                   help='number of rules to report')
+    p.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    if args.command != 'profile':
+        parser.print_help()
+        return 2
+    try:
+        result = profile(args.builddir)
+    except (OSError, ExecutionError) as e:
+        print('ninju: {}'.format(e), file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(format_profile(result, args.top))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,15 @@
 import unittest
 from test_core import TestCore
 from test_use_cases import TestUseCases
+from test_ninja_syntax import TestExpand, TestWriter
 
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(TestCore())
     suite.addTest(TestUseCases())
+    suite.addTest(TestWriter())
+    suite.addTest(TestExpand())
     return suite
 
 
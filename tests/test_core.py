@@ -1,15 +1,22 @@
+import asyncio
 import inspect
+import json
 import os
 import sys
+import tempfile
+import time
+import tracemalloc
 import unittest
 import warnings
+from unittest import mock
 from io import StringIO
 from helper import generate_ninja, Header
 
 sourcedir = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(0, os.path.join(sourcedir, '../src'))
 
-from ninju import Ninju, ConfigurationError, NinjuWarning
+from ninju import Ninju, ConfigurationError, ExeResolver, ExecutionError, GeneratorError, NinjuWarning
+from ninju import profile, read_ninja_log
 
 MODULE_FILE = os.path.abspath(__file__)
 
@@ -110,6 +117,10 @@ class TestCore(unittest.TestCase):
             result = generate_ninja(n, newline=False)
             self.assertEqual(result, expected[0])
 
+            # Values are expanded as ninja does.
+            n.var('other', '$$${myvar}$ $undefined')
+            self.assertEqual(n._vars['other'], '$myvalue ')
+
     def test_cmd(self):
         self.maxDiff = None
         with warnings.catch_warnings():
@@ -213,3 +224,778 @@ class TestCore(unittest.TestCase):
 
             with self.assertRaises(ConfigurationError):
                 n.cmd('cmd1', 'bin1', pool='pool_1')
+
+    def test_stream(self):
+        self.maxDiff = None
+
+        def declare(n):
+            src = n.dir('src')
+            n.var('myvar', 'myvalue')
+            n.cmd('cmd1', 'bin1', '${in} ${out}', pool=2)
+            n.cmd('cmd2', 'bin2', '${in} ${out}')
+            a = src('a.txt').cmd1(outputs=2).cmd2()
+            n.target('all').phony(a)
+            n.default('all')
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            for newline in (True, False):
+                n = Ninju(no_cwd_check=True)
+                declare(n)
+                s = Ninju(no_cwd_check=True, stream=True, spool_size=16)
+                declare(s)
+                self.assertEqual(len(s._seq), 5)
+                self.assertEqual(generate_ninja(s, newline=newline),
+                                 generate_ninja(n, newline=newline))
+
+    def test_stream_memory(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+
+            def declare(count):
+                n = Ninju(no_cwd_check=True, stream=True, spool_size=1)
+                src = n.dir('src')
+                n.cmd('cmd1', 'bin1', '${in} ${out}')
+                tracemalloc.start()
+                try:
+                    for i in range(count):
+                        src('a%d.txt' % i).cmd1('${builddir}/a%d.out' % i)
+                    return n, tracemalloc.get_traced_memory()[0]
+                finally:
+                    tracemalloc.stop()
+
+            n, small = declare(1000)
+            n, large = declare(10000)
+            # Only the length of each statement is kept.
+            self.assertLess(large - small, 16 * 9000)
+            with self.assertRaises(ConfigurationError):
+                n.graph
+            with self.assertRaises(ConfigurationError):
+                n.check()
+
+    def test_generate_unchanged(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            with tempfile.TemporaryDirectory() as d:
+                n = Ninju(no_cwd_check=True)
+                n._root_dir = d
+                n.cmd('cmd1', 'bin1', '${in} ${out}')
+                n.root('a.txt').cmd1()
+                path = os.path.join(d, 'build.ninja')
+
+                self.assertTrue(n.generate())
+                mtime = os.stat(path).st_mtime_ns
+                content = generate_ninja(n)
+                with open(path) as f:
+                    self.assertEqual(f.read(), content)
+
+                self.assertFalse(n.generate())
+                self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+
+                n.root('b.txt').cmd1()
+                self.assertTrue(n.generate())
+                self.assertEqual(os.listdir(d), ['build.ninja'])
+
+    def test_script_and_root(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            n = Ninju(no_cwd_check=True)
+            self.assertEqual(n._file, MODULE_FILE)
+            self.assertEqual(n._root_dir, os.path.dirname(MODULE_FILE))
+
+            n = Ninju(no_cwd_check=True, script='/path/configure.py')
+            self.assertEqual(n._file, '/path/configure.py')
+            self.assertEqual(n._root_dir, '/path')
+
+            n = Ninju(no_cwd_check=True, script='/path/configure.py',
+                      root='/other')
+            self.assertEqual(n._root_dir, '/other')
+
+    def test_resolver(self):
+        class FakeResolver(object):
+            def __init__(self):
+                self.calls = []
+
+            def resolve(self, path):
+                self.calls.append(path)
+                if path == 'bin1':
+                    return '/fake/bin1'
+                return None
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            r = FakeResolver()
+            n = Ninju(no_cwd_check=True, script='/path/configure.py',
+                      resolver=r)
+            n.cmd('cmd1', 'bin1', '${in} ${out}')
+            self.assertEqual(n._seq[-1].executable, '/fake/bin1')
+            with self.assertWarns(NinjuWarning):
+                n.cmd('cmd2', 'bin2', '${in} ${out}')
+            self.assertEqual(r.calls, ['/path/configure.py', 'bin1', 'bin2'])
+
+    def test_resolver_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            bindir = os.path.join(d, 'bin')
+            os.mkdir(bindir)
+            exe = os.path.join(bindir, 'tool')
+            with open(exe, 'w') as f:
+                f.write('#!/bin/sh\n')
+            os.chmod(exe, 0o755)
+            cache_file = os.path.join(d, 'exe_cache.json')
+
+            old_path = os.environ.get('PATH')
+            os.environ['PATH'] = bindir
+            try:
+                r = ExeResolver(cache_file=cache_file)
+                self.assertEqual(r.resolve('tool'), exe)
+                self.assertEqual(r.resolve('missing'), None)
+                r.save()
+
+                with mock.patch('shutil.which', side_effect=AssertionError):
+                    self.assertEqual(r.resolve('tool'), exe)
+                    self.assertEqual(ExeResolver(cache_file).resolve('tool'), exe)
+
+                # Removing the file changes the mtime of the PATH directory.
+                os.remove(exe)
+                self.assertEqual(r.resolve('tool'), exe)
+                r.invalidate()
+                self.assertEqual(r.resolve('tool'), None)
+                self.assertEqual(ExeResolver(cache_file).resolve('tool'), None)
+            finally:
+                os.environ['PATH'] = old_path
+
+    def test_cmd_methods(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            n = Ninju(no_cwd_check=True)
+            n.cmd('cmd1', 'bin1', '${in} ${out}')
+            n.exec_cmd('cmd2', 'bin2', '${in}')
+            a = n.root('a.txt')
+            self.assertFalse(hasattr(a, '__dict__'))
+            self.assertTrue(hasattr(a, 'cmd1'))
+            self.assertFalse(hasattr(a, 'cmd2'))
+            self.assertTrue(hasattr(n.target('t'), 'cmd2'))
+            self.assertFalse(hasattr(n.target('t'), 'cmd1'))
+
+            # Commands are only available on files of the same Ninju object.
+            other = Ninju(no_cwd_check=True)
+            self.assertFalse(hasattr(other.root('a.txt'), 'cmd1'))
+
+            with self.assertRaises(ConfigurationError):
+                n.cmd('files', 'bin1')
+            with self.assertRaises(ConfigurationError):
+                n.exec_cmd('phony', 'bin1')
+
+    def test_files_flatten(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            n = Ninju(no_cwd_check=True)
+            a = n.files('a', ['b', ('c', None, ['d'])], None)
+            self.assertEqual(a.files, ('a', 'b', 'c', 'd'))
+            self.assertEqual(str(a), "['a', 'b', 'c', 'd']")
+            self.assertEqual('{}'.format(a), "['a', 'b', 'c', 'd']")
+
+            b = n.files(a)
+            self.assertIs(b.files, a.files)
+            c = n.files('x', a, [a, 'y'])
+            self.assertEqual(c.files, ('x', 'a', 'b', 'c', 'd', 'a', 'b', 'c', 'd', 'y'))
+
+            deep = 'z'
+            for i in range(sys.getrecursionlimit() * 2):
+                deep = [deep]
+            self.assertEqual(n.files(deep).files, ('z',))
+
+    def test_dir_paths(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            n = Ninju(no_cwd_check=True)
+            src = n.dir('src/')
+            self.assertEqual(src('a.txt').files, ('${root}/src/a.txt',))
+            self.assertEqual(src('sub', 'a.txt').files, ('${root}/src/sub/a.txt',))
+            self.assertEqual(src('/abs/a.txt').files, ('/abs/a.txt',))
+            self.assertEqual(src('').files, ('${root}/src/',))
+            self.assertEqual(n.dir()('a.txt').files, ('${root}/a.txt',))
+            self.assertEqual(n.builddir('a.txt').files, ('${builddir}/a.txt',))
+            self.assertEqual(n.root().files, ('${root}',))
+
+    def test_shards(self):
+        self.maxDiff = None
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            with tempfile.TemporaryDirectory() as d:
+                def declare(count):
+                    n = Ninju(no_cwd_check=True, root=d, shards=3)
+                    n.cmd('cmd1', 'bin1', '${in} ${out}')
+                    for i in range(count):
+                        n.root('file%d.txt' % i).cmd1(n.builddir('out%d.txt' % i))
+                    n.target('all').phony(n.builddir('out0.txt'))
+                    n.default('all')
+                    return n
+
+                n = declare(20)
+                self.assertTrue(n.generate())
+                with open(os.path.join(d, 'build.ninja')) as f:
+                    root = f.read()
+                self.assertIn('rule cmd1\n', root)
+                self.assertNotIn(': cmd1 ', root)
+                self.assertIn("build ${root}/build.ninja | ${root}/build.1.ninja ${root}/build.2.ninja $\n", root)
+                self.assertTrue(root.endswith("""include ${root}/build.1.ninja
+
+include ${root}/build.2.ninja
+
+include ${root}/build.3.ninja
+
+default all
+
+"""))
+
+                shards = {}
+                for i in range(1, 4):
+                    path = os.path.join(d, 'build.%d.ninja' % i)
+                    with open(path) as f:
+                        shards[path] = (f.read(), os.stat(path).st_mtime_ns)
+                builds = ''.join(v[0] for v in shards.values())
+                for i in range(20):
+                    self.assertIn('build ${builddir}/out%d.txt: cmd1' % i, builds)
+                self.assertIn('build all: phony', builds)
+
+                self.assertFalse(declare(20).generate())
+
+                # Only the shard that receives the new statement is rewritten.
+                self.assertTrue(declare(21).generate())
+                changed = [p for p, v in shards.items()
+                           if os.stat(p).st_mtime_ns != v[1]]
+                self.assertEqual(len(changed), 1)
+
+    def test_generate_jobs(self):
+        self.maxDiff = None
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            n = Ninju(no_cwd_check=True)
+            src = n.dir('src')
+            n.cmd('cmd1', 'bin1', '${in} ${out}', pool=2)
+            n.cmd('cmd2', 'bin2', '${in} ${out}')
+            for i in range(50):
+                src('a%d.txt' % i).cmd1(outputs=2).cmd2(variables={'i': str(i)})
+            n.target('all').phony(src('a0.txt'))
+            n.default('all')
+
+            for newline in (True, False):
+                o = StringIO()
+                n._generate(o, newline)
+                # The default start method of the process is left unset.
+                with mock.patch('ninju._MIN_CHUNK', 7), \
+                        mock.patch('multiprocessing.get_start_method',
+                                   side_effect=AssertionError):
+                    p = StringIO()
+                    n._generate(p, newline, jobs=3)
+                self.assertEqual(p.getvalue(), o.getvalue())
+
+            # Without fork, workers would run the configure script again.
+            with mock.patch('ninju._MIN_CHUNK', 7), \
+                    mock.patch('multiprocessing.get_all_start_methods',
+                               return_value=['spawn']), \
+                    mock.patch('ninju.ProcessPoolExecutor', side_effect=AssertionError):
+                p = StringIO()
+                n._generate(p, newline, jobs=3)
+            self.assertEqual(p.getvalue(), o.getvalue())
+
+    def test_graph(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            n = Ninju(no_cwd_check=True)
+            src = n.dir('src')
+            n.cmd('cmd1', 'bin1', '${in} ${out}')
+            n.cmd('cmd2', 'bin2', '${in} ${out}')
+            a = src('a.txt').cmd1(n.builddir('a.o'))
+            b = src('b.txt').cmd1(n.builddir('b.o'))
+            n.files(a, b).cmd2(n.builddir('out'))
+            n.target('all').phony(n.builddir('out'))
+
+            g = n.graph
+            self.assertEqual(g.producer('${builddir}/a.o'),
+                             ('cmd1', ('${builddir}/a.o',), ('${root}/src/a.txt', 'bin1')))
+            self.assertEqual(g.producer('${root}/src/a.txt'), None)
+            self.assertEqual([e.outputs for e in g.consumers(a)],
+                             [('${builddir}/out',)])
+            self.assertEqual(g.dependencies('all'), {
+                '${builddir}/out', '${builddir}/a.o', '${builddir}/b.o',
+                '${root}/src/a.txt', '${root}/src/b.txt', 'bin1', 'bin2'})
+            self.assertEqual(g.dependents('${root}/src/b.txt'),
+                             {'${builddir}/b.o', '${builddir}/out', 'all'})
+            self.assertEqual(g.find_cycle(), None)
+
+            with self.assertRaises(ConfigurationError):
+                src('c.txt').cmd1(n.builddir('a.o'))
+            with self.assertRaises(ConfigurationError):
+                n.target('all').phony(a)
+            with self.assertRaises(GeneratorError):
+                n.check()
+
+            n.builddir('out').cmd1(src('b.txt'))
+            cycle = g.find_cycle()
+            self.assertEqual(cycle[0], cycle[-1])
+            self.assertEqual(set(cycle), {
+                '${root}/src/b.txt', '${builddir}/b.o', '${builddir}/out'})
+            with self.assertRaises(GeneratorError):
+                n.check(dangling=False)
+
+    def test_edge_store(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            n = Ninju(no_cwd_check=True)
+            src = n.dir('src')
+            n.cmd('cmd1', 'bin1', '${in} ${out}')
+            seq = len(n._seq)
+            for i in range(100):
+                src('a%d.txt' % i).cmd1('${builddir}/a%d.out' % i, variables={'v': '1'})
+            # Consecutive build statements share one entry.
+            self.assertEqual(len(n._seq), seq + 1)
+
+            edges = len(n.graph)
+            with self.assertRaises(ConfigurationError):
+                src('b.txt').cmd1(['${builddir}/b.out', '${builddir}/a5.out'])
+            self.assertEqual(len(n.graph), edges)
+            src('b.txt').cmd1('${builddir}/b.out')
+            self.assertEqual(n.graph.producer('${builddir}/b.out').inputs,
+                             ('${root}/src/b.txt', 'bin1'))
+
+            # An output repeated in the same edge, checked in linear time
+            outputs = ['${builddir}/c%d.out' % i for i in range(20000)]
+            with self.assertRaises(ConfigurationError):
+                src('c.txt').cmd1(outputs + ['${builddir}/c0.out'])
+            self.assertIsNone(n.graph.producer('${builddir}/c0.out'))
+            src('c.txt').cmd1(outputs[:2])
+
+            o = StringIO()
+            n._generate(o)
+            self.assertIn('''build ${builddir}/a99.out: cmd1 ${root}/src/a99.txt | bin1
+  v = 1
+
+build ${builddir}/b.out: cmd1 ${root}/src/b.txt | bin1
+
+build ${builddir}/c0.out ${builddir}/c1.out: cmd1 ${root}/src/c.txt | bin1
+''', o.getvalue())
+
+    def test_stable_names(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+
+            def declare(extra):
+                n = Ninju(no_cwd_check=True, stable_names=True)
+                src = n.dir('src')
+                n.cmd('cmd1', 'bin1', '${in} ${out}')
+                n.cmd('cmd2', 'bin2', '${in} ${out}')
+                if extra:
+                    src('x.txt').cmd1()
+                a = src('a.txt').cmd1(outputs=2)
+                b = a.cmd2(variables={'v': '1'})
+                c = a.cmd2(variables={'v': '2'})
+                return n, a.files + b.files + c.files
+
+            n, names = declare(False)
+            self.assertEqual(len(set(names)), 4)
+            for name in names:
+                self.assertRegex(name, r'^\$\{builddir\}/\.ninju_[0-9a-f]{16}\.tmp$')
+            self.assertEqual(declare(True)[1], names)
+
+            # An identical edge still gets its own outputs.
+            d = n.files(names[:2]).cmd2(variables={'v': '1'})
+            self.assertEqual(d.files[0], names[2][:-4] + '-2.tmp')
+            with self.assertRaises(ConfigurationError):
+                Ninju(no_cwd_check=True, stable_names=True, stream=True)
+
+            # Edges with explicit outputs are not hashed.
+            n.cmd('cmd3', 'bin3', '${in} ${out}', batchable=True)
+            with mock.patch('ninju._edge_hash', side_effect=AssertionError):
+                n.dir('src')('e.txt').cmd1('${builddir}/e.out')
+                n.files(names).batch(
+                    'cmd3', 2, outputs=['${builddir}/b%d' % i for i in range(len(names))])
+
+    def test_optimize(self):
+        self.maxDiff = None
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            n = Ninju(no_cwd_check=True)
+            src = n.dir('some', 'source', 'directory')
+            n.cmd('cmd1', 'bin1', '${in} ${out}')
+            n.cmd('cmd2', 'bin1', '${in} ${out}')
+            flags = '-DA_LONG_DEFINE=1 -DANOTHER_ONE=2'
+            for i in range(3):
+                src('a%d.txt' % i).cmd1('${builddir}/a%d.out' % i, variables={'f': flags})
+            src('b.txt').cmd2('${builddir}/b.out')
+
+            o = StringIO()
+            n._generate(o, optimize=True)
+            body = o.getvalue()
+            body = body[body.index('rule cmd1'):]
+            self.assertEqual(body, '''rule cmd1
+  command = bin1 ${in} ${out}
+
+ninju_v1 = -DA_LONG_DEFINE=1 -DANOTHER_ONE=2
+
+ninju_p1 = ${root}/some/source/directory
+
+build ${builddir}/a0.out: cmd1 ${ninju_p1}/a0.txt | bin1
+  f = ${ninju_v1}
+
+build ${builddir}/a1.out: cmd1 ${ninju_p1}/a1.txt | bin1
+  f = ${ninju_v1}
+
+build ${builddir}/a2.out: cmd1 ${ninju_p1}/a2.txt | bin1
+  f = ${ninju_v1}
+
+build ${builddir}/b.out: cmd1 ${ninju_p1}/b.txt | bin1
+
+''')
+            o = StringIO()
+            n._generate(o)
+            self.assertIn('rule cmd2', o.getvalue())
+
+    def test_batch(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            n = Ninju(no_cwd_check=True)
+            src = n.dir('src')
+            n.cmd('conv', 'conv', '@${rspfile} ${out}', batchable=True)
+            n.cmd('cmd1', 'bin1', '${in} ${out}')
+            files = n.files([src('a%d.txt' % i) for i in range(5)])
+            outs = files.batch('conv', 2, outputs=['${builddir}/a%d.out' % i for i in range(5)],
+                               variables={'v': '1'})
+            self.assertEqual(list(outs), ['${builddir}/a%d.out' % i for i in range(5)])
+
+            o = StringIO()
+            n._generate(o)
+            self.assertIn('''rule conv
+  command = conv @${rspfile} ${out}
+  rspfile = ${ninju_rsp}
+  rspfile_content = ${in_newline}
+''', o.getvalue())
+            self.assertIn('''build ${builddir}/a4.out: conv ${root}/src/a4.txt | conv
+  ninju_rsp = ${builddir}/a4.out.rsp
+  v = 1
+''', o.getvalue())
+            edge = n.graph.producer('${builddir}/a2.out')
+            self.assertEqual(edge.outputs, ('${builddir}/a2.out', '${builddir}/a3.out'))
+            self.assertEqual(len(files.batch('conv', 3).files), 5)
+
+            with self.assertRaises(ConfigurationError):
+                files.batch('cmd1', 2)
+            with self.assertRaises(ConfigurationError):
+                files.batch('conv', 2, outputs=['x'])
+
+    def test_later(self):
+        self.maxDiff = None
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            with tempfile.TemporaryDirectory() as d:
+                n = Ninju(no_cwd_check=True, root=d)
+                src = n.dir('src')
+                n.cmd('cmd1', 'bin1', '${in} ${out}')
+                # Finishes after the futures declared after it.
+                slow = n.submit(lambda: time.sleep(0.2) or 'a.txt')
+                first = n.later(slow, lambda f: src(f).cmd1())
+                cmd2 = n.acmd('cmd2', 'bin2', '${in} ${out}')
+                second = n.later(n.submit(lambda: 'b.txt'), lambda f: src(f).cmd1())
+                src('c.txt').cmd1('${builddir}/c.out')
+
+                async def declare():
+                    await cmd2
+                    return await second
+                self.assertEqual(asyncio.run(declare()).files, ('${builddir}/.ninju_2.tmp',))
+                self.assertEqual(first.result().files, ('${builddir}/.ninju_1.tmp',))
+
+                later = n.later(n.submit(lambda: 'd.txt'), lambda f: src(f).cmd2())
+                self.assertFalse(later.done())
+                with self.assertRaises(ConfigurationError):
+                    n.section('s', lambda: later.result())
+
+                # The executable is looked up once, in the background.
+                resolver = mock.Mock()
+                resolver.resolve.return_value = None
+                m = Ninju(no_cwd_check=True, root=d, resolver=resolver)
+                tool = m.acmd('tool', m.root('tool.sh'))
+                tool.result()
+                self.assertEqual(resolver.resolve.call_args_list[-2:],
+                                 [mock.call('./tool.sh')] * 2)
+                n.generate()
+                self.assertTrue(later.done())
+                with open(os.path.join(d, 'build.ninja')) as f:
+                    result = f.read()
+                self.assertIn('''build ${builddir}/.ninju_1.tmp: cmd1 ${root}/src/a.txt | bin1
+
+rule cmd2
+  command = bin2 ${in} ${out}
+
+build ${builddir}/.ninju_2.tmp: cmd1 ${root}/src/b.txt | bin1
+
+build ${builddir}/c.out: cmd1 ${root}/src/c.txt | bin1
+
+build ${builddir}/.ninju_3.tmp: cmd2 ${root}/src/d.txt | bin2
+''', result)
+
+    def test_snapshot(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            with tempfile.TemporaryDirectory() as d:
+                n = Ninju(no_cwd_check=True, root=d)
+                src = n.dir('src')
+                n.cmd('cmd1', 'bin1', '${in} ${out}', pool=2)
+                n.cmd('cmd2', 'bin2', '${in} ${out}')
+                a = src('a.txt').cmd1('${builddir}/a.out', variables={'v': '1'})
+                b = n.files(a, src('é.txt')).cmd2('${builddir}/b.out')
+                n.target('all').phony(b)
+                n.generate(snapshot=True)
+
+                snap = Ninju.load_snapshot(os.path.join(d, 'build.ninja.snap'))
+                self.assertEqual(list(snap), list(n.graph))
+                self.assertEqual(snap.producer('${builddir}/b.out'),
+                                 n.graph.producer('${builddir}/b.out'))
+                self.assertIsNone(snap.producer('${root}/src/a.txt'))
+                self.assertIsNone(snap.producer('missing'))
+                self.assertEqual(snap.consumers('${builddir}/a.out'),
+                                 n.graph.consumers('${builddir}/a.out'))
+                self.assertEqual(snap.dependencies('all'), n.graph.dependencies('all'))
+                self.assertEqual(snap.sources(), n.graph.sources())
+                self.assertEqual(snap.variables('${builddir}/a.out'), [['v', '1']])
+                self.assertEqual(snap.rules['cmd2']['executable'], 'bin2')
+                self.assertEqual(snap.pools, {'pool_2': 2})
+                self.assertEqual(snap.vars['builddir'], './.builddir')
+                with self.assertRaises(ConfigurationError):
+                    snap.add('cmd1', ['x'], [])
+
+                with open(os.path.join(d, 'bad.snap'), 'wb') as f:
+                    f.write(b'not a snapshot')
+                with self.assertRaises(ExecutionError):
+                    Ninju.load_snapshot(os.path.join(d, 'bad.snap'))
+
+    def test_section(self):
+        self.maxDiff = None
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            with tempfile.TemporaryDirectory() as d:
+                # Not a list, as values used by the section are part of its
+                # fingerprint.
+                calls = mock.Mock()
+
+                def declare(count):
+                    n = Ninju(no_cwd_check=True, root=d)
+                    src = n.dir('src')
+                    n.cmd('cmd1', 'bin1', '${in} ${out}')
+
+                    def data():
+                        calls(count)
+                        outs = [src('a%d.txt' % i).cmd1() for i in range(count)]
+                        n.target('data').phony(outs)
+                        return {'outs': outs, 'count': count}
+
+                    r = n.section('data', data, key=count)
+                    r['outs'][0].cmd1(n.builddir('final.txt'))
+                    return n, r
+
+                n1, r1 = declare(3)
+                n2, r2 = declare(3)
+                calls.assert_called_once_with(3)
+                self.assertEqual(generate_ninja(n2), generate_ninja(n1))
+                self.assertEqual(str(r2['outs']), str(r1['outs']))
+                self.assertEqual(r2['count'], 3)
+                self.assertEqual(n2._name_count, n1._name_count)
+                self.assertIsNotNone(n2.graph.producer('data'))
+
+                declare(4)
+                self.assertEqual(calls.call_count, 2)
+
+                # Editing a generator module invalidates the section.
+                helpers = os.path.join(d, 'helpers.py')
+                module = mock.Mock(__file__=helpers)
+                for content in ('x = 1\n', 'x = 2\n'):
+                    with open(helpers, 'w') as f:
+                        f.write(content)
+                    for i in range(2):
+                        n = Ninju(no_cwd_check=True, root=d, generators=[module])
+                        n.section('gen', lambda: calls('gen') and None)
+                self.assertEqual(calls.call_count, 4)
+
+                n = Ninju(no_cwd_check=True, root=d)
+                with self.assertRaises(ConfigurationError):
+                    n.section('vars', lambda: n.var('x', 'y'))
+
+    def test_glob(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            with tempfile.TemporaryDirectory() as d:
+                os.makedirs(os.path.join(d, 'data', 'sub'))
+                for f in ('b.csv', 'a.csv', '.hidden.csv', 'c.txt', 'sub/d.csv'):
+                    open(os.path.join(d, 'data', f), 'w').close()
+
+                n = Ninju(no_cwd_check=True, root=d)
+                data = n.dir('data')
+                self.assertEqual(data.glob('*.csv').files,
+                                 ('${root}/data/a.csv', '${root}/data/b.csv'))
+                self.assertEqual(data.glob('.*').files,
+                                 ('${root}/data/.hidden.csv',))
+                self.assertEqual(data.glob('sub/*').files,
+                                 ('${root}/data/sub/d.csv',))
+                self.assertEqual(data.glob('*.json').files, ())
+                self.assertTrue(hasattr(data.glob('*.csv'), 'configure'))
+
+                out = generate_ninja(n)
+                self.assertIn('${root}/data $\n    ${root}/data/sub\n', out)
+
+                open(os.path.join(d, 'data', 'e.csv'), 'w').close()
+                os.utime(os.path.join(d, 'data'), ns=(0, 0))
+                self.assertEqual(len(data.glob('*.csv').files), 3)
+
+                with self.assertRaises(ConfigurationError):
+                    data.glob('*/x.csv')
+                with self.assertRaises(ConfigurationError):
+                    n.dir('missing').glob('*')
+
+                # Directories globbed in a cached section
+                calls = mock.Mock()
+
+                def declare():
+                    n = Ninju(no_cwd_check=True, root=d)
+                    data = n.dir('data')
+
+                    def csv():
+                        calls()
+                        return data.glob('*.csv')
+                    return n, n.section('csv', csv)
+
+                n1, r1 = declare()
+                n2, r2 = declare()
+                self.assertEqual(calls.call_count, 1)
+                self.assertEqual(r2.files, r1.files)
+                self.assertIn('${root}/data', n2._configure_build.implicit.files)
+                self.assertEqual(generate_ninja(n2), generate_ninja(n1))
+
+                open(os.path.join(d, 'data', 'f.csv'), 'w').close()
+                os.utime(os.path.join(d, 'data'), ns=(1, 1))
+                n3, r3 = declare()
+                self.assertEqual(calls.call_count, 2)
+                self.assertEqual(len(r3.files), 4)
+
+    def test_resource_pool(self):
+        self.maxDiff = None
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            n = Ninju(no_cwd_check=True, resources={'cpu': 16, 'mem_mb': 8000})
+            n.cmd('link', 'ninju_ld', mem_mb=3000)
+            n.cmd('cc', 'ninju_cc', cpu=1)
+            n.cmd('union', 'union', cpu=2, mem_mb=1000)
+            n.cmd('big', 'big', mem_mb=100000)
+            n.cmd('cc2', 'ninju_cc', cpu=1)
+            result = generate_ninja(n, newline=False)
+            self.assertEqual(result, Header(MODULE_FILE) + """
+pool pool_cpu1_mem3000
+  depth = 2
+rule link
+  command = ninju_ld
+  pool = pool_cpu1_mem3000
+pool pool_cpu1
+  depth = 16
+rule cc
+  command = ninju_cc
+  pool = pool_cpu1
+pool pool_cpu2_mem1000
+  depth = 8
+rule union
+  command = union
+  pool = pool_cpu2_mem1000
+pool pool_cpu1_mem100000
+  depth = 1
+rule big
+  command = big
+  pool = pool_cpu1_mem100000
+rule cc2
+  command = ninju_cc
+  pool = pool_cpu1
+""")
+
+            with self.assertRaises(ConfigurationError):
+                n.cmd('x', 'x', pool=1, cpu=1)
+            with self.assertRaises(ConfigurationError):
+                n.cmd('x', 'x', cpu=0)
+
+    def test_profile(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            with tempfile.TemporaryDirectory() as d:
+                n = Ninju(no_cwd_check=True, root=d, record_sites=True)
+                src = n.dir('src')
+                n.cmd('cmd1', 'bin1', '${in} ${out}')
+                n.cmd('cmd2', 'bin2', '${in} ${out}')
+                a = src('a.txt').cmd1(n.builddir('a.o'))
+                line = inspect.currentframe().f_lineno - 1
+                b = src('b.txt').cmd1(n.builddir('b.o'))
+                n.files(a, b).cmd2(n.builddir('out'))
+                n.generate()
+
+                builddir = os.path.join(d, '.builddir')
+                with open(os.path.join(builddir, '.ninja_log'), 'w') as f:
+                    f.write('# ninja log v5\n')
+                    # An older run, not used
+                    f.write('0\t4000\t0\t.builddir/out\t3\n')
+                    f.write('4000\t9000\t0\t.builddir/old.o\t5\n')
+                    f.write('0\t50\t0\tbuild.ninja\t4\n')
+                    f.write('0\t100\t0\t.builddir/b.o\t2\n')
+                    f.write('0\t500\t0\t.builddir/a.o\t1\n')
+                    f.write('500\t800\t0\t.builddir/out\t3\n')
+
+                log = read_ninja_log(os.path.join(builddir, '.ninja_log'))
+                self.assertNotIn('.builddir/old.o', log)
+                self.assertEqual(log['.builddir/out'], (500, 800))
+
+                result = profile(builddir)
+                self.assertEqual(result['critical_path_ms'], 800)
+                self.assertEqual(
+                    [(e['output'], e['duration_ms']) for e in result['critical_path']],
+                    [('.builddir/a.o', 500), ('.builddir/out', 300)])
+                self.assertEqual(result['critical_path'][0]['site'],
+                                 '{}:{}'.format(__file__, line))
+                self.assertEqual(result['rules'][0], {
+                    'rule': 'cmd1', 'count': 2, 'total_ms': 600,
+                    'mean_ms': 300, 'p95_ms': 500})
+
+    def test_exports(self):
+        self.maxDiff = None
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=NinjuWarning)
+            with tempfile.TemporaryDirectory() as d:
+                n = Ninju(no_cwd_check=True, root=d, script='/path/configure.py')
+                src = n.dir('src')
+                n.var('flags', '-O2')
+                n.cmd('cc', '/path/cc', '${flags} -c ${in} -o ${out} ${extra}')
+                n.cmd('link', '/path/ld', '${in} -o ${out}')
+                a = src('a.c').cc(n.builddir('a.o'), variables={'extra': '-g'})
+                b = src('b c.c').cc(n.builddir('b.o'))
+                n.files(a, b).link(n.builddir('app'))
+
+                n.generate(exports={'compdb': 'compile_commands.json',
+                                    'dot': 'graph.dot',
+                                    'edges': 'edges.jsonl'})
+
+                with open(os.path.join(d, 'compile_commands.json')) as f:
+                    compdb = json.load(f)
+                self.assertEqual(compdb[0], {
+                    'directory': d,
+                    'command': '/path/cc -O2 -c src/a.c -o .builddir/a.o -g',
+                    'file': 'src/a.c',
+                    'output': '.builddir/a.o'})
+                self.assertEqual(compdb[1]['command'],
+                                 "/path/cc -O2 -c 'src/b c.c' -o .builddir/b.o ")
+                self.assertEqual(compdb[2]['command'],
+                                 '/path/ld .builddir/a.o .builddir/b.o -o .builddir/app')
+
+                with open(os.path.join(d, 'edges.jsonl')) as f:
+                    edges = [json.loads(l) for l in f]
+                self.assertEqual(edges[-1], {
+                    'rule': 'link', 'outputs': ['${builddir}/app'],
+                    'inputs': ['${builddir}/a.o', '${builddir}/b.o', '/path/ld']})
+
+                with open(os.path.join(d, 'graph.dot')) as f:
+                    dot = f.read()
+                self.assertTrue(dot.startswith('digraph ninja {\n'))
+                self.assertIn('[label="link", shape=ellipse]', dot)
+                self.assertIn('[label="${builddir}/app"]', dot)
@@ -0,0 +1,71 @@
+import os
+import sys
+import unittest
+from io import StringIO
+
+sourcedir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(sourcedir, '../src'))
+
+from ninja_syntax import Expander, Writer, expand
+
+
+def write_build(width, outputs, rule, inputs):
+    o = StringIO()
+    Writer(o, width).build(outputs, rule, inputs=inputs)
+    return o.getvalue()
+
+
+class TestWriter(unittest.TestCase):
+
+    def test_wrap(self):
+        self.maxDiff = None
+        inputs = ['${root}/src/file%d.txt' % i for i in range(8)]
+        result = write_build(78, 'out.txt', 'cat', inputs)
+        self.assertEqual(result, """build out.txt: cat ${root}/src/file0.txt ${root}/src/file1.txt $
+    ${root}/src/file2.txt ${root}/src/file3.txt ${root}/src/file4.txt $
+    ${root}/src/file5.txt ${root}/src/file6.txt ${root}/src/file7.txt
+""")
+
+    def test_wrap_escaped_space(self):
+        self.maxDiff = None
+        result = write_build(30, 'out.txt', 'cat',
+                             ['a file with spaces.txt', 'b.txt'])
+        self.assertEqual(result, """build out.txt: cat $
+    a$ file$ with$ spaces.txt $
+    b.txt
+""")
+
+    def test_escape(self):
+        result = write_build(None, ['c:/out.txt', 'o.txt'], 'cat',
+                             ['a b.txt', 'c.txt', 'd$ e'])
+        self.assertEqual(result, 'build c$:/out.txt o.txt: cat a$ b.txt c.txt d$$$ e\n')
+        self.assertEqual(write_build(None, 'o.txt', 'cat', []), 'build o.txt: cat\n')
+
+    def test_no_wrap(self):
+        self.maxDiff = None
+        inputs = ['${root}/src/file%d.txt' % i for i in range(8)]
+        result = write_build(None, 'out.txt', 'cat', inputs)
+        self.assertEqual(result, 'build out.txt: cat ' + ' '.join(inputs) + '\n')
+
+        o = StringIO()
+        Writer(o, None).comment('x' * 100)
+        self.assertEqual(o.getvalue(), '# ' + 'x' * 100 + '\n')
+
+
+class TestExpand(unittest.TestCase):
+
+    def test_expand(self):
+        v = {'root': '.', 'out': 'a.o', 'foo-bar': 'x'}
+        self.assertEqual(expand('${root}/a $out.d $foo-bar', v), './a a.o.d x')
+        self.assertEqual(expand('a$$b c$ d$:e $\n    f', v), 'a$b c d:e f')
+        self.assertEqual(expand('$undefined/$in', v, {'in': 'i'}), '/i')
+        self.assertEqual(expand('50$', v), '50$')
+
+    def test_expander(self):
+        e = Expander()
+        e.define('a', '1')
+        self.assertEqual(e.expand('$a/$b'), '1/')
+        e.define('b', '2')
+        self.assertEqual(e.expand('$a/$b'), '1/2')
+        e.define('a', '3')
+        self.assertEqual(e.expand('$a/$b'), '3/2')